@@ -0,0 +1,97 @@
+"""Stub of the Domoticz plugin module for running plugin.py outside of Domoticz"""
+
+# every Debug/Log/Error/Status call as (level, message)
+log = []
+echo = False
+debugging = 0
+heartbeat = 10
+
+# the runner shares this dict with plugin.Devices
+Devices = {}
+
+
+def _log(level, message):
+    if level == 'Debug' and debugging == 0:
+        return
+    log.append((level, message))
+    if echo:
+        print("{}: {}".format(level, message))
+
+
+def Debug(message):
+    _log('Debug', message)
+
+
+def Log(message):
+    _log('Log', message)
+
+
+def Status(message):
+    _log('Status', message)
+
+
+def Error(message):
+    _log('Error', message)
+
+
+def Debugging(mode):
+    global debugging
+    debugging = mode
+
+
+def Heartbeat(seconds):
+    global heartbeat
+    heartbeat = seconds
+
+
+def Notifier(name):
+    pass
+
+
+def reset():
+    global debugging, heartbeat
+    del log[:]
+    Devices.clear()
+    debugging = 0
+    heartbeat = 10
+
+
+class Device:
+    """Child device, Create() adds it to Devices like Domoticz does"""
+
+    def __init__(self, Name="", Unit=0, TypeName="", Type=0, Subtype=0, Switchtype=0, Image=0, Options=None, Used=0,
+                 DeviceID="", Description=""):
+        self.Name = Name
+        self.Unit = Unit
+        self.TypeName = TypeName
+        self.Type = Type
+        self.SubType = Subtype
+        self.SwitchType = Switchtype
+        self.Image = Image
+        self.Options = dict(Options or {})
+        self.Used = Used
+        self.DeviceID = DeviceID or str(Unit)
+        self.Description = Description
+        self.ID = Unit
+        self.nValue = 0
+        self.sValue = ""
+        self.LastLevel = 0
+        self.updates = 0
+
+    def Create(self):
+        Devices[self.Unit] = self
+
+    def Update(self, nValue=None, sValue=None, Options=None, SuppressTriggers=False, **kwargs):
+        if nValue is not None:
+            self.nValue = nValue
+        if sValue is not None:
+            self.sValue = sValue
+        if Options is not None:
+            self.Options = dict(Options)
+        self.updates += 1
+
+    def Delete(self):
+        Devices.pop(self.Unit, None)
+
+    def __str__(self):
+        return "Unit: {}, Name: '{}', nValue: {}, sValue: '{}'".format(self.Unit, self.Name, self.nValue, self.sValue)
@@ -0,0 +1,207 @@
+"""Benchmarks of the plugin hot paths against the fake Domoticz API
+
+    python harness/bench.py --save harness/bench_baseline.json
+    python harness/bench.py --compare harness/bench_baseline.json
+
+Every case reports the wall time of the callback (median, I/O worker excluded), the memory allocated during the
+call (tracemalloc peak) and the API requests it caused. --compare exits with 1 when a case allocates more or makes
+more requests than the baseline. Sub-millisecond times are mostly timer and scheduler noise, with --time a case
+also fails when its fastest run got slower by more than the spread of the runs.
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+from datetime import timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from runner import Harness
+
+SIZES = (1, 5, 10, 25, 50)
+TIME_FLOOR_MS = 0.05  # smallest time difference taken as a regression
+TIME_NOISE = 3  # interquartile ranges of the runs a time difference must exceed
+
+
+def heartbeat_calc(harness, i):
+    # heartbeat with a PID calculation due, sensors alternate so valve writes happen
+    for idx in harness.zones[0][0]:
+        harness.fake.set_temp(idx, 19.0 if i % 2 else 20.5)
+    harness.plugin._plugin.zones[0].next_calc = harness.clock.now()
+    harness.plugin._plugin.wake()
+    harness.advance(10)
+    return harness.plugin.onHeartbeat
+
+
+def heartbeat_idle(harness, i):
+    # heartbeat between two calculations
+    harness.advance(10)
+    harness.plugin._plugin.zones[0].next_calc = harness.clock.now() + timedelta(minutes=1)
+    return harness.plugin.onHeartbeat
+
+
+def set_target_temp(harness, i):
+    plugin = harness.plugin._plugin
+    zone = plugin.zones[0]
+
+    def call():
+        plugin.set_target_temp(zone, 21.0 + i % 2, 0.5, force=True)
+        plugin.flush_writes()
+
+    return call
+
+
+def command_set_level(harness, i):
+    level = 20 if i % 2 else 10
+    return lambda: harness.plugin.onCommand(1, 'Set Level', level, None)
+
+
+def load_internals(harness, i):
+    plugin = harness.plugin._plugin
+    return lambda: plugin.load_internals(plugin.zones[0])
+
+
+CASES = (
+    ('onHeartbeat/calc', heartbeat_calc),
+    ('onHeartbeat/idle', heartbeat_idle),
+    ('set_target_temp', set_target_temp),
+    ('onCommand/SetLevel', command_set_level),
+    ('load_internals', load_internals),
+)
+
+
+def finish(harness):
+    # completes the I/O of the call, including jobs queued by its completions
+    for i in range(3):
+        harness.settle()
+        harness.plugin._plugin.process_completions()
+
+
+def measure(case, size, repeats, rate_limits=False):
+
+    harness = Harness(sensors=size, valves=size, seed=1)
+    harness.start()
+    if not rate_limits:
+        # every case sends what it computes, held back writes would leak into the next cases
+        harness.plugin._plugin.write_bucket.rate = 0
+        harness.plugin._plugin.valve_min_interval = 0
+    harness.command(1, 10)
+    finish(harness)
+
+    times, allocs, requests = [], [], []
+    for i in range(repeats):
+        call = case(harness, i)
+        before = len(harness.fake.calls)
+
+        started = time.perf_counter()
+        call()
+        times.append(time.perf_counter() - started)
+
+        finish(harness)
+        requests.append(len(harness.fake.calls) - before)
+
+    # allocations in separate calls, tracemalloc slows the timed ones down
+    for i in range(repeats, repeats + max(3, repeats // 4)):
+        call = case(harness, i)
+        tracemalloc.start()
+        tracemalloc.reset_peak()
+        call()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        allocs.append(peak)
+        finish(harness)
+
+    harness.stop()
+
+    quartiles = statistics.quantiles(times, n=4)
+    return {'time_ms': round(1000 * statistics.median(times), 4),
+            'time_min_ms': round(1000 * min(times), 4),
+            'time_spread_ms': round(1000 * (quartiles[2] - quartiles[0]), 4),
+            'alloc_kb': round(min(allocs) / 1024.0, 2),
+            'http': round(statistics.mean(requests), 2)}
+
+
+def run(sizes, repeats, only=None, rate_limits=False):
+
+    results = {}
+    for name, case in CASES:
+        if only and not any(name.startswith(prefix) for prefix in only):
+            continue
+        for size in sizes:
+            key = "{}/n={}".format(name, size)
+            results[key] = measure(case, size, repeats, rate_limits)
+            print("{:<28} {:>9.3f} ms {:>9.2f} kB {:>6.2f} req".format(key, results[key]['time_ms'],
+                                                                      results[key]['alloc_kb'], results[key]['http']))
+    return results
+
+
+def compare(results, baseline, time_tol, alloc_tol, check_time=False):
+    # list of regressions against the baseline results
+
+    regressions = []
+    for key, new in sorted(results.items()):
+        old = baseline.get(key)
+        if old is None:
+            continue
+
+        # the fastest run is the least disturbed one, the difference must also be above the spread of both runs
+        if check_time and 'time_min_ms' in old:
+            noise = TIME_NOISE * max(old['time_spread_ms'], new['time_spread_ms']) + TIME_FLOOR_MS
+            if new['time_min_ms'] > old['time_min_ms'] * time_tol and new['time_min_ms'] - old['time_min_ms'] > noise:
+                regressions.append("{} time {:.3f} ms -> {:.3f} ms (fastest run, noise {:.3f} ms)".format(
+                    key, old['time_min_ms'], new['time_min_ms'], noise))
+
+        # a small absolute floor keeps allocator noise from failing the run
+        if new['alloc_kb'] > old['alloc_kb'] * alloc_tol and new['alloc_kb'] - old['alloc_kb'] > 1.0:
+            regressions.append("{} alloc {:.2f} kB -> {:.2f} kB".format(key, old['alloc_kb'], new['alloc_kb']))
+        if new['http'] > old['http'] + 0.01:
+            regressions.append("{} requests {} -> {}".format(key, old['http'], new['http']))
+
+    return regressions
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Benchmark the plugin hot paths")
+    parser.add_argument('--sizes', default=",".join(str(size) for size in SIZES), help="sensors/valves per run, csv")
+    parser.add_argument('--repeats', type=int, default=20)
+    parser.add_argument('--only', action='append', help="case name prefix, repeatable")
+    parser.add_argument('--rate-limits', action='store_true', help="keep the valve write rate limits on")
+    parser.add_argument('--save', help="write the results as a baseline json")
+    parser.add_argument('--compare', help="baseline json to compare with")
+    parser.add_argument('--time', action='store_true', help="also fail on slower times, best on an idle machine")
+    parser.add_argument('--time-tolerance', type=float, default=1.5, help="allowed time ratio to the baseline")
+    parser.add_argument('--alloc-tolerance', type=float, default=1.2, help="allowed allocation ratio to the baseline")
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(",")]
+    results = run(sizes, args.repeats, args.only, args.rate_limits)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'python': platform.python_version(), 'machine': platform.machine(), 'repeats': args.repeats,
+                       'results': results}, f, indent=1, sort_keys=True)
+        print("baseline saved to {}".format(args.save))
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline.get('repeats') != args.repeats:
+            # the first calls of a case make more requests, their share depends on the repeats
+            print("baseline ran {} repeats, this run {} - request counts may differ".format(baseline.get('repeats'),
+                                                                                             args.repeats))
+        regressions = compare(results, baseline['results'], args.time_tolerance, args.alloc_tolerance, args.time)
+        for regression in regressions:
+            print("REGRESSION " + regression)
+        if regressions:
+            sys.exit(1)
+        print("no regression against {}".format(args.compare))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,233 @@
+"""In-process stand-in for the Domoticz json.htm API used by plugin.py
+
+Serves devices (filter, rid, lastupdate), setsetpoint and the user variable commands. Every request is recorded,
+latency and failures can be injected per request.
+"""
+
+import json
+import random
+import threading
+import time
+from datetime import datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+
+class FakeDomoticz:
+    """Devices, user variables and request log of the fake server"""
+
+    def __init__(self, clock=None, latency=0.0, fail_rate=0.0, seed=None):
+        self.clock = clock or datetime.now
+        self.latency = latency  # seconds added to every request
+        self.fail_rate = fail_rate  # probability of a failed request
+        self.fail_mode = 'error'  # 'error' - status ERR, 'http' - HTTP 500, 'timeout' - no reply within fail_delay
+        self.fail_delay = 10.0
+        self.fail_next = 0  # the next n requests fail
+        self.fail_params = set()  # params (e.g. 'setsetpoint') which always fail
+        self.random = random.Random(seed)
+        self.devices = {}
+        self.updated = {}  # idx -> epoch of the last change, for lastupdate=
+        self.wakes = {}  # valve idx -> [wake up interval in seconds, next wake up], battery valves reporting on wake up
+        self.variables = {}
+        self.calls = []
+        self.lock = threading.Lock()
+        self.server = None
+
+    # devices
+
+    def _touch(self, idx, now=None):
+        now = now or self.clock()
+        self.devices[idx]['LastUpdate'] = now.strftime('%Y-%m-%d %H:%M:%S')
+        self.updated[idx] = now.timestamp()
+
+    def add_temp(self, idx, temp, name=None):
+        with self.lock:
+            self.devices[idx] = {'idx': str(idx), 'Name': name or "Temp {}".format(idx), 'Type': 'Temp',
+                                 'SubType': 'LaCrosse TX3', 'Temp': float(temp), 'Data': "{} C".format(temp)}
+            self._touch(idx)
+
+    def add_valve(self, idx, setpoint, name=None):
+        with self.lock:
+            self.devices[idx] = {'idx': str(idx), 'Name': name or "TRV {}".format(idx), 'Type': 'Thermostat',
+                                 'SubType': 'SetPoint', 'SetPoint': "{:.2f}".format(setpoint), 'AddjValue': 0.0,
+                                 'Data': "{:.2f}".format(setpoint)}
+            self._touch(idx)
+
+    def add_switch(self, idx, status='Closed', name=None):
+        with self.lock:
+            self.devices[idx] = {'idx': str(idx), 'Name': name or "Window {}".format(idx), 'Type': 'Light/Switch',
+                                 'SubType': 'Switch', 'SwitchType': 'Door Contact', 'Status': status, 'Data': status}
+            self._touch(idx)
+
+    def set_temp(self, idx, temp):
+        with self.lock:
+            self.devices[idx]['Temp'] = float(temp)
+            self.devices[idx]['Data'] = "{} C".format(temp)
+            self._touch(idx)
+
+    def set_status(self, idx, status):
+        with self.lock:
+            self.devices[idx]['Status'] = status
+            self.devices[idx]['Data'] = status
+            self._touch(idx)
+
+    def set_wake(self, idx, interval, offset=0):
+        # the valve reports (LastUpdate) every interval seconds from now + offset
+        with self.lock:
+            self.wakes[idx] = [interval, self.clock().timestamp() + offset]
+
+    def tick(self):
+        # wake ups of the battery valves up to the current time
+        now = self.clock().timestamp()
+        with self.lock:
+            for idx, wake in self.wakes.items():
+                if wake[1] <= now:
+                    while wake[1] + wake[0] <= now:
+                        wake[1] += wake[0]
+                    self._touch(idx, datetime.fromtimestamp(wake[1]))
+                    wake[1] += wake[0]
+
+    def setpoint(self, idx):
+        return float(self.devices[idx]['SetPoint'])
+
+    # request log
+
+    def count(self, **match):
+        # number of recorded requests whose params contain all of match
+        with self.lock:
+            return sum(1 for call in self.calls if all(call.get(k) == str(v) for k, v in match.items()))
+
+    def reset_calls(self):
+        with self.lock:
+            del self.calls[:]
+
+    # server
+
+    def start(self, port=0):
+        # port 0 picks a free port, returned
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), _make_handler(self))
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name="fake-json.htm", daemon=True).start()
+        return self.server.server_address[1]
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def handle(self, params):
+        # returns (http status, response dict)
+
+        with self.lock:
+            self.calls.append(params)
+
+            fail = params.get('param') in self.fail_params or params.get('type') in self.fail_params
+            if self.fail_next > 0:
+                self.fail_next -= 1
+                fail = True
+            elif self.fail_rate > 0 and self.random.random() < self.fail_rate:
+                fail = True
+
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+        if fail:
+            if self.fail_mode == 'http':
+                return 500, {}
+            if self.fail_mode == 'timeout':
+                time.sleep(self.fail_delay)
+            return 200, {'status': 'ERR', 'title': 'injected failure'}
+
+        with self.lock:
+            return 200, self._dispatch(params)
+
+    def _dispatch(self, params):
+
+        reply = {'status': 'OK', 'title': params.get('param', params.get('type', ''))}
+        kind, param = params.get('type'), params.get('param')
+
+        if kind == 'devices':
+            now = self.clock()
+            reply['ActTime'] = int(now.timestamp())
+            if 'rid' in params:
+                idx = int(params['rid'])
+                reply['result'] = [dict(self.devices[idx])] if idx in self.devices else []
+            else:
+                since = float(params.get('lastupdate', 0))
+                reply['result'] = [dict(device) for idx, device in sorted(self.devices.items())
+                                   if self.updated.get(idx, 0) >= since]
+
+        elif param == 'setsetpoint':
+            idx = int(params['idx'])
+            if idx not in self.devices:
+                return {'status': 'ERR', 'title': 'unknown device'}
+            self.devices[idx]['SetPoint'] = "{:.2f}".format(float(params['setpoint']))
+            if 'addjvalue' in params:
+                self.devices[idx]['AddjValue'] = float(params['addjvalue'])
+            self._touch(idx)
+
+        elif param == 'getuservariables':
+            reply['result'] = [self._variable(idx) for idx in sorted(self.variables)]
+
+        elif param == 'getuservariable':
+            idx = int(params['idx'])
+            if idx not in self.variables:
+                return {'status': 'ERR', 'title': 'unknown variable'}
+            reply['result'] = [self._variable(idx)]
+
+        elif param == 'adduservariable':
+            if any(name == params['vname'] for name, value in self.variables.values()):
+                return {'status': 'ERR', 'title': 'Variable name already exists!'}
+            idx = max(self.variables, default=0) + 1
+            self.variables[idx] = (params['vname'], params['vvalue'])
+
+        elif param == 'updateuservariable':
+            for idx, (name, value) in self.variables.items():
+                if name == params['vname']:
+                    self.variables[idx] = (name, params['vvalue'])
+                    break
+            else:
+                return {'status': 'ERR', 'title': 'unknown variable'}
+
+        else:
+            return {'status': 'ERR', 'title': 'not implemented'}
+
+        return reply
+
+    def _variable(self, idx):
+        name, value = self.variables[idx]
+        return {'idx': str(idx), 'Name': name, 'Type': '2', 'Value': value}
+
+
+def _make_handler(fake):
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        wbufsize = -1  # headers and body in one write, unbuffered writes stall on delayed ACKs
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            params = {k: v[0] for k, v in parse_qs(url.query).items()}
+            length = int(self.headers.get('Content-Length') or 0)
+            if length > 0:
+                params.update({k: v[0] for k, v in parse_qs(self.rfile.read(length).decode()).items()})
+
+            if url.path != '/json.htm':
+                status, reply = 404, {}
+            else:
+                status, reply = fake.handle(params)
+
+            body = json.dumps(reply).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        do_POST = do_GET
+
+    return Handler
@@ -0,0 +1,238 @@
+"""Headless runner: drives plugin.py callbacks against the fake json.htm server on a virtual clock
+
+    python harness/runner.py --zones 2 --sensors 2 --valves 3 --hours 24
+
+The plugin sees time through a patched plugin.datetime, so a day of heartbeats runs in seconds. After every
+callback the runner waits for the plugin I/O worker to finish its queued jobs.
+"""
+
+import argparse
+import importlib.util
+import os
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+HARNESS_DIR = os.path.dirname(os.path.abspath(__file__))
+PLUGIN_PATH = os.path.join(os.path.dirname(HARNESS_DIR), 'plugin.py')
+
+if HARNESS_DIR not in sys.path:
+    sys.path.insert(0, HARNESS_DIR)
+
+import Domoticz
+from fake_api import FakeDomoticz
+
+
+class VirtualClock:
+    """Time seen by the plugin and the fake server"""
+
+    def __init__(self, start=None):
+        self.current = start or datetime(2026, 1, 5, 6, 0, 0)
+
+    def now(self):
+        return self.current
+
+    def advance(self, seconds):
+        self.current += timedelta(seconds=seconds)
+
+
+def clocked_datetime(clock):
+    # datetime class whose now() is the virtual clock, strptime and arithmetic are untouched
+
+    class ClockedDateTime(datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return clock.now()
+
+    return ClockedDateTime
+
+
+def load_plugin(name='svtp_plugin'):
+    # a fresh module per harness, plugin.py keeps its state in module globals
+
+    spec = importlib.util.spec_from_file_location(name, PLUGIN_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def make_parameters(port, zones, home, name='SVTP', address='127.0.0.1', temp_params='21.0,20.0,5.0,0.5,0.1,2.0',
+                    time_params='3,1,10,90,15', pid_params='0.9,0.1,0.2,0,1,1', hardware_id=1):
+    # zones: list of (sensors, windows, valves) idx lists
+
+    def groups(index):
+        return ";".join(",".join(str(idx) for idx in zone[index]) for zone in zones)
+
+    return {'Name': name, 'HardwareID': hardware_id, 'HomeFolder': home, 'Address': address, 'Port': str(port),
+            'Mode1': groups(0), 'Mode2': groups(1), 'Mode3': groups(2), 'Mode4': temp_params,
+            'Mode5': time_params, 'Mode6': pid_params}
+
+
+class Harness:
+    """One plugin instance, its Parameters/Devices fixtures and a fake Domoticz"""
+
+    def __init__(self, zones=1, sensors=2, valves=2, windows=0, latency=0.0, fail_rate=0.0, temp=19.0, setpoint=20.0,
+                 start=None, home=None, seed=None, echo=False, **params):
+
+        self.clock = VirtualClock(start)
+        self.fake = FakeDomoticz(self.clock.now, latency, fail_rate, seed)
+
+        # idx blocks of 1000 per zone: sensors x100, windows x300, valves x500
+        self.zones = []
+        for zone in range(zones):
+            base = 1000 * (zone + 1)
+            self.zones.append(([base + 100 + i for i in range(sensors)],
+                               [base + 300 + i for i in range(windows)],
+                               [base + 500 + i for i in range(valves)]))
+            for idx in self.zones[-1][0]:
+                self.fake.add_temp(idx, temp)
+            for idx in self.zones[-1][1]:
+                self.fake.add_switch(idx)
+            for idx in self.zones[-1][2]:
+                self.fake.add_valve(idx, setpoint)
+
+        self.own_home = home is None  # removed by stop()
+        self.home = home or tempfile.mkdtemp(prefix='svtp-harness-')
+        self.port = self.fake.start()
+        self.parameters = make_parameters(self.port, self.zones, self.home, **params)
+
+        Domoticz.reset()
+        Domoticz.echo = echo
+        self.log = Domoticz.log
+        self.devices = Domoticz.Devices
+
+        self.plugin = load_plugin()
+        self.plugin.Parameters = self.parameters
+        self.plugin.Devices = self.devices
+        self.plugin.datetime = clocked_datetime(self.clock)
+        # the fake listens on a new port every run, its shared device cache file goes with the home folder
+        self.plugin._plugin.shared_dir = self.home
+
+    @property
+    def worker(self):
+        return self.plugin._plugin.worker
+
+    def settle(self):
+        # waits for the jobs queued by the last callback, completions are picked up by the next one
+
+        worker = self.worker
+        if worker is not None and worker.is_alive():
+            worker.jobs.join()
+
+    def timed(self, func, *args):
+        # wall time of one callback in seconds, I/O worker time excluded
+
+        started = time.perf_counter()
+        func(*args)
+        elapsed = time.perf_counter() - started
+        self.settle()
+        return elapsed
+
+    def start(self):
+        return self.timed(self.plugin.onStart)
+
+    def stop(self):
+        elapsed = self.timed(self.plugin.onStop)
+        self.fake.stop()
+        if self.own_home:
+            shutil.rmtree(self.home, ignore_errors=True)
+        return elapsed
+
+    def heartbeat(self):
+        return self.timed(self.plugin.onHeartbeat)
+
+    def command(self, unit, level):
+        # level 0 is Off, 10/20/30 Normal/Economy/Pause
+
+        if level == 0:
+            return self.timed(self.plugin.onCommand, unit, 'Off', 0, None)
+        return self.timed(self.plugin.onCommand, unit, 'Set Level', level, None)
+
+    def notify(self, idx, text):
+        return self.timed(self.plugin.onNotification, self.fake.devices[idx]['Name'], "", text, "", 0, "", "")
+
+    def advance(self, seconds):
+        self.clock.advance(seconds)
+
+    def warm_room(self, minutes, rate=0.02):
+        # crude room model: sensors move towards the mean valve setpoint by rate per minute
+
+        for sensors, windows, valves in self.zones:
+            target = sum(self.fake.setpoint(idx) for idx in valves) / len(valves)
+            for idx in sensors:
+                temp = self.fake.devices[idx]['Temp']
+                self.fake.set_temp(idx, round(temp + (target - temp) * min(1.0, rate * minutes), 2))
+
+    def run(self, minutes, heartbeat=None, model=True):
+        # heartbeats every heartbeat seconds (plugin requested interval by default), returns their wall times
+
+        times = []
+        end = self.clock.now() + timedelta(minutes=minutes)
+        while self.clock.now() < end:
+            interval = heartbeat or Domoticz.heartbeat
+            self.advance(interval)
+            self.fake.tick()
+            if model:
+                self.warm_room(interval / 60.0)
+            times.append(self.heartbeat())
+        return times
+
+    def errors(self):
+        return [message for level, message in self.log if level == 'Error']
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Run plugin.py headless against a fake Domoticz")
+    parser.add_argument('--zones', type=int, default=1)
+    parser.add_argument('--sensors', type=int, default=2, help="temperature sensors per zone")
+    parser.add_argument('--valves', type=int, default=2, help="valves per zone")
+    parser.add_argument('--windows', type=int, default=0, help="window sensors per zone")
+    parser.add_argument('--hours', type=float, default=24.0, help="virtual time to run")
+    parser.add_argument('--heartbeat', type=int, default=None, help="seconds between heartbeats")
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds added to every API request")
+    parser.add_argument('--fail-rate', type=float, default=0.0, help="share of API requests failing")
+    parser.add_argument('--wake', type=int, default=0, help="battery valves waking up every n seconds")
+    parser.add_argument('--mode5', default='3,1,10,90,15')
+    parser.add_argument('--mode6', default='0.9,0.1,0.2,0,1,1')
+    parser.add_argument('--echo', action='store_true', help="print the plugin log")
+    args = parser.parse_args()
+
+    harness = Harness(args.zones, args.sensors, args.valves, args.windows, args.latency, args.fail_rate,
+                      seed=1, echo=args.echo, time_params=args.mode5, pid_params=args.mode6)
+
+    if args.wake > 0:
+        for sensors, windows, valves in harness.zones:
+            for i, idx in enumerate(valves):
+                harness.fake.set_wake(idx, args.wake, 17 * i)
+
+    started = time.perf_counter()
+    harness.start()
+    for zone in range(args.zones):
+        harness.command(zone + 1, 10)
+    times = harness.run(args.hours * 60, args.heartbeat)
+    harness.stop()
+    wall = time.perf_counter() - started
+
+    calls = {}
+    for call in harness.fake.calls:
+        key = call.get('param', call.get('type'))
+        calls[key] = calls.get(key, 0) + 1
+
+    print("virtual {:.1f} h in {:.2f} s wall, {} heartbeats".format(args.hours, wall, len(times)))
+    if times:
+        times.sort()
+        print("heartbeat mean {:.3f} ms, p50 {:.3f} ms, max {:.3f} ms".format(
+            1000 * sum(times) / len(times), 1000 * times[len(times) // 2], 1000 * times[-1]))
+    print("API requests: {}".format(", ".join("{} {}".format(k, v) for k, v in sorted(calls.items()))))
+    for sensors, windows, valves in harness.zones:
+        print("zone temps {} setpoints {}".format([harness.fake.devices[idx]['Temp'] for idx in sensors],
+                                                  [harness.fake.setpoint(idx) for idx in valves]))
+    errors = harness.errors()
+    print("{} errors{}".format(len(errors), "" if not errors else ", last: " + errors[-1]))
+
+
+if __name__ == '__main__':
+    main()
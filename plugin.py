@@ -12,23 +12,44 @@ Version: 0.0.1 (November 24, 2020) - see history.txt for versions history
         <h2>Smart Virtual Thermostat with PID</h2><br/>
     </description>
     <params>
+        <param field="Address" label="Domoticz IP Address" width="200px" required="true" default="127.0.0.1"/>
+        <param field="Port" label="Domoticz Port" width="40px" required="true" default="8080"/>
         <param field="Mode1" label="Inside Temperature Sensors (csv list of idx)" width="100px" required="true" default=""/>
         <param field="Mode2" label="Open Window Sensors (csv list of idx)" width="100px" required="false" default=""/>
         <param field="Mode3" label="Thermostat Radiator Valves (csv list of idx)" width="100px" required="true" default=""/>
         <param field="Mode4" label="High/Low/Pause/TRV prec/Sensor prec/Max shift" width="200px" required="true" default="21,20,5,0.5,0.1,2"/>
-        <param field="Mode5" label="Calc. interval, Pause On delay, Pause Off delay, Sensor Timeout (all in minutes)" width="200px" required="true" default="3,1,10,90"/>
-        <param field="Mode6" label="PID Params P/I/D/Debug/E/C" width="200px" required="true" default="0.9,0.10,0.2,1,1,1"/>
+        <param field="Mode5" label="Calc. interval, Pause On delay, Pause Off delay, Sensor Timeout, Save interval (all in minutes)" width="200px" required="true" default="3,1,10,90,15"/>
+        <param field="Mode6" label="PID Params P/I/D/Debug/E/C/S/M/A/T" width="200px" required="true" default="0.9,0.10,0.2,1,1,1"/>
     </params>
 </plugin>
 """
 
 import Domoticz as domoticz
+import ast
 import json
-import urllib, requests
+import os
+import tempfile
 from datetime import datetime, timedelta
 import time
-import base64
 import itertools
+import functools
+from collections import deque
+import math
+import random
+import bisect
+import heapq
+from array import array
+import re
+import mmap
+import struct
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # no shared device cache without flock (Windows)
 
 
 class deviceparam:
@@ -39,17 +60,1069 @@ class deviceparam:
         self.svalue = svalue
 
 
+class PluginLog:
+    """Plugin log with the level checked before any formatting and rate limited repeated messages"""
+
+    DEBUG = 0
+    LOG = 1
+    ERROR = 2
+
+    def __init__(self, repeat_interval=600):
+        self.debugging = True
+        self.repeat_interval = repeat_interval  # seconds during which a repeated message is held back
+        self.repeats = {}  # key -> [time of the last written message, messages held back since]
+
+    def write(self, level, fmt, args, suffix=""):
+        message = (fmt.format(*args) if args else fmt) + suffix
+
+        if level == self.DEBUG:
+            domoticz.Debug(message)
+        elif level == self.LOG:
+            domoticz.Log(message)
+        else:
+            domoticz.Error(message)
+
+    def debug(self, fmt, *args):
+        if self.debugging:
+            self.write(self.DEBUG, fmt, args)
+
+    def log(self, fmt, *args):
+        self.write(self.LOG, fmt, args)
+
+    def error(self, fmt, *args):
+        self.write(self.ERROR, fmt, args)
+
+    def limited(self, level, key, fmt, *args):
+        # messages with the same key are written once per repeat_interval, with the number held back
+
+        if level == self.DEBUG and not self.debugging:
+            return
+
+        now = datetime.now()
+        repeat = self.repeats.get(key)
+        if repeat is not None and (now - repeat[0]).total_seconds() < self.repeat_interval:
+            repeat[1] += 1
+            return
+
+        suffix = " ({} repeats held back)".format(repeat[1]) if repeat is not None and repeat[1] > 0 else ""
+
+        self.repeats[key] = [now, 0]
+        self.write(level, fmt, args, suffix)
+
+
+logger = PluginLog()
+
+
+class APIError(Exception):
+    """Failed Domoticz API call, reason: 'error' - Domoticz answered, 'unavailable' - no connection or HTTP 5xx,
+    'timeout' - no answer in time, 'suspended' - not sent, the circuit breaker is open"""
+
+    def __init__(self, message, reason='error'):
+        super().__init__(message)
+        self.reason = reason
+
+
+class Histogram:
+    """Fixed bucket latency histogram in ms"""
+
+    BOUNDS = (0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+    def __init__(self):
+        self.buckets = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.buckets[bisect.bisect_left(self.BOUNDS, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, share):
+        # upper bound of the bucket holding the share, never above the largest value seen
+        wanted = share * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= wanted and n > 0:
+                return min(self.BOUNDS[i], self.max) if i < len(self.BOUNDS) else self.max
+        return 0.0
+
+    def summary(self):
+        return "n {} avg {:.2f} p95 {:.2f} max {:.2f} ms".format(self.count, self.total / self.count if self.count else 0.0,
+                                                              self.percentile(0.95), self.max)
+
+
+class Metrics:
+    """Counters and histograms of one reporting period, shared with the I/O threads"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = datetime.now()
+        self.counters = {}
+        self.histograms = {}
+
+    def incr(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, name, value):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(value)
+
+    def collect(self, now):
+        # returns (period minutes, counters, histograms) and starts a new period
+        with self.lock:
+            period = (now - self.started).total_seconds() / 60.0
+            counters, histograms = self.counters, self.histograms
+            self.started, self.counters, self.histograms = now, {}, {}
+        return period, counters, histograms
+
+
+class CircuitBreaker:
+    """Stops the API calls after consecutive failures, after a cooldown a single probe call tests Domoticz"""
+
+    def __init__(self, threshold, cooldown, max_cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown  # seconds
+        self.max_cooldown = max_cooldown
+        self.lock = threading.Lock()  # calls come from the I/O worker and its write pool
+        self.failures = 0
+        self.wait = cooldown  # seconds of the current cooldown, doubled by every failed probe
+        self.retry_at = None  # None - closed, calls pass; else no call before this time
+        self.probing = False
+
+    def allow(self, now):
+        # True when the call may be sent, the first call after the cooldown becomes the probe
+
+        with self.lock:
+            if self.retry_at is None:
+                return True
+            if self.probing or now < self.retry_at:
+                return False
+            self.probing = True
+            return True
+
+    def holds(self, now):
+        # the next call would be refused
+        return self.retry_at is not None and (self.probing or now < self.retry_at)
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.wait = self.cooldown
+            self.retry_at = None
+            self.probing = False
+
+    def failure(self, now):
+        with self.lock:
+            self.failures += 1
+            if self.probing:
+                self.probing = False
+                self.wait = min(2 * self.wait, self.max_cooldown)
+                self.retry_at = now + timedelta(seconds=self.wait)
+            elif self.retry_at is None and self.failures >= self.threshold:
+                self.retry_at = now + timedelta(seconds=self.wait)
+
+
+class DomoticzAPI:
+    """Plugin-owned client for the Domoticz JSON API, reusing one keep-alive connection"""
+
+    def __init__(self, address='127.0.0.1', port='8080', timeout=5.0):
+        self.base_url = 'http://{}:{}/json.htm'.format(address, port)
+        self.timeout = timeout
+        self.session = None  # opened by the first call
+        self.errors = ()  # exceptions of the HTTP client
+        self.timeouts = ()
+        self.executor = None
+        self.metrics = None  # per-endpoint latency and errors when set
+        self.retries = READ_RETRIES
+        self.breaker = CircuitBreaker(BREAKER_FAILURES, BREAKER_COOLDOWN, BREAKER_COOLDOWN_MAX)
+
+    def get(self, params, timeout=None):
+        # reads are idempotent: an unreachable Domoticz is retried after a jittered, growing delay
+        # a timeout is not retried - a busy Domoticz would only get more requests
+
+        for attempt in range(self.retries + 1):
+            try:
+                return self.request('GET', params, timeout)
+            except APIError as e:
+                if e.reason != 'unavailable' or attempt == self.retries or self.breaker.retry_at is not None:
+                    raise
+            if self.metrics is not None:
+                self.metrics.incr('api.retries')
+            time.sleep(random.uniform(0.5, 1.0) * RETRY_DELAY * 2 ** attempt)
+
+    def post(self, params, timeout=None):
+        return self.request('POST', params, timeout)
+
+    def request(self, method, params, timeout=None):
+
+        if not self.breaker.allow(datetime.now()):
+            if self.metrics is not None:
+                self.metrics.incr('api.rejected')
+            raise APIError("{} {} not sent - Domoticz API suspended".format(method, params), 'suspended')
+
+        # any answer of Domoticz closes the breaker, also when it is an error
+        failed = True
+        try:
+            result = self.measure(method, params, timeout)
+            failed = False
+            return result
+        except APIError as e:
+            failed = e.reason in ('unavailable', 'timeout')
+            raise
+        finally:
+            if failed:
+                self.breaker.failure(datetime.now())
+            else:
+                self.breaker.success()
+
+    def measure(self, method, params, timeout=None):
+
+        if self.metrics is None:
+            return self.call(method, params, timeout)
+
+        endpoint = "api." + str(params.get('param', params.get('type')))
+        started = time.perf_counter()
+        try:
+            return self.call(method, params, timeout)
+        except APIError:
+            self.metrics.incr(endpoint + ".errors")
+            raise
+        finally:
+            self.metrics.observe(endpoint, 1000.0 * (time.perf_counter() - started))
+
+    def connect(self):
+        # requests takes seconds to import on small boards, the I/O worker pays for it instead of onStart
+
+        import requests
+        self.errors = requests.RequestException
+        self.timeouts = requests.Timeout
+        self.session = requests.Session()
+
+    def call(self, method, params, timeout=None):
+        # returns the decoded json answer, raises APIError when the call failed
+        # no domoticz logging here - this runs on the I/O worker thread
+
+        if self.session is None:
+            self.connect()
+
+        try:
+            response = self.session.request(method, self.base_url, params=params,
+                                            timeout=self.timeout if timeout is None else timeout)
+        except self.timeouts as e:
+            raise APIError("{} {} timed out: {}".format(method, params, e), 'timeout')
+        except self.errors as e:
+            raise APIError("{} {} failed: {}".format(method, params, e), 'unavailable')
+
+        if response.status_code != 200:
+            raise APIError("{} {} responded {}".format(method, params, response.status_code),
+                           'unavailable' if response.status_code >= 500 else 'error')
+
+        try:
+            v_json = response.json()
+        except ValueError:
+            raise APIError("{} {} returned invalid json".format(method, params))
+
+        if v_json.get('status') == 'ERR':
+            raise APIError("{} {} returned ERR".format(method, params))
+
+        return v_json
+
+    def post_many(self, params_list, max_workers=4, timeout=None):
+        # concurrent posts on a bounded pool, returns (result, error) in params_list order
+
+        if self.session is None:
+            self.connect()
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="SVTP-IO-pool")
+
+        def post_one(params):
+            try:
+                return self.post(params, timeout), None
+            except APIError as e:
+                return None, e
+
+        return list(self.executor.map(post_one, params_list))
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+        if self.session is not None:
+            self.session.close()
+
+
+def write_setpoints(api, batch, max_workers, shared=None, wanted=()):
+    """Posts every setpoint of the batch concurrently, then reads all valves back in one bulk request"""
+
+    invalidate_shared(shared, [int(params['idx']) for params in batch])
+    results = api.post_many(batch, max_workers)
+
+    try:
+        devices = api.get({'type': 'devices', 'filter': 'all'}).get('result', [])
+    except APIError:
+        devices = None
+
+    if devices is not None:
+        publish_shared(shared, devices, wanted)
+    return results, devices
+
+
+def read_devices(api, params, shared, wanted, known, use_api=True):
+    """Bulk device read, served from the shared cache when another instance read every wanted device a moment ago,
+    otherwise read from the API and handed to the other instances as soon as it arrives"""
+
+    if shared is not None:
+        try:
+            fresh, found = shared.read(wanted, SHARED_FRESH, datetime.now().timestamp(), known)
+        except (OSError, ValueError):
+            fresh, found = 0, {}
+        if fresh >= len(wanted) or not use_api:
+            return {'shared': found, 'complete': fresh >= len(wanted)}
+
+    result = api.get(params)
+    publish_shared(shared, result.get('result', []), wanted, params.get('lastupdate'))
+    return result
+
+
+# the shared cache is only touched by the I/O worker jobs: a flock on the plugin thread would wait behind the other
+# instances and for the GIL behind a busy worker; failures leave the other instances reading the API themselves
+
+def publish_shared(shared, devices, wanted, confirm_since=None):
+    if shared is not None:
+        try:
+            shared.write(devices, wanted, datetime.now().timestamp(), confirm_since)
+        except (OSError, ValueError):
+            pass
+
+
+def invalidate_shared(shared, idx_list):
+    # the written valves are read from the API by the next reader
+    if shared is not None:
+        try:
+            shared.invalidate(idx_list)
+        except (OSError, ValueError):
+            pass
+
+
+class IOWorker(threading.Thread):
+    """Runs Domoticz API jobs off the plugin callbacks, results are picked up as completions"""
+
+    def __init__(self, api):
+        super().__init__(name="SVTP-IO", daemon=True)
+        self.api = api
+        self.jobs = queue.Queue()
+        self.completions = queue.Queue()
+
+    def submit(self, name, func, args, context=None):
+        # context (the zone of the job) is handed back untouched with the completion
+        self.jobs.put((name, func, args, context))
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            name, func, args, context = job
+            try:
+                self.completions.put((name, args, context, func(self.api, *args), None))
+            except Exception as e:
+                self.completions.put((name, args, context, None, e))
+            self.jobs.task_done()
+
+    def pending(self):
+        # jobs queued or running
+        return self.jobs.unfinished_tasks
+
+    def has_completions(self):
+        return not self.completions.empty()
+
+    def next_completion(self):
+        try:
+            return self.completions.get_nowait()
+        except queue.Empty:
+            return None
+
+    def stop(self, timeout=10.0):
+        # queued jobs (setpoints, internals) are still executed before the sentinel
+        self.jobs.put(None)
+        self.join(timeout)
+
+
+class FileStateStore:
+    """Internals kept in a local file, replaced atomically so a power loss leaves either the old or the new state"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def load(self):
+        with open(self.path, 'r') as f:
+            return f.read()
+
+    def save(self, valuestring):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(valuestring + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+
+def write_user_variable(api, params, cache):
+    """Posts the Internals user variable, then mirrors it into the local cache file read by the next onStart"""
+
+    result = api.post(params)
+    try:
+        cache.save(params['vvalue'])
+    except OSError:
+        pass  # the cache only speeds up the next start
+    return result
+
+
+def write_state_file(api, store, valuestring):
+    # I/O worker job - fsync on an SD card is too slow for the callback thread
+    store.save(valuestring)
+
+
+class TelemetryRecorder:
+    """Control loop history as fixed size records in a memory-mapped, size-capped file, rotated when full
+
+    The file starts with a header describing the records (TELEMETRY_HEADER) and the number of records written,
+    tools/telemetry.py reads it back.
+    """
+
+    def __init__(self, path, capacity=None, keep=None):
+        self.path = path
+        self.capacity = capacity or TELEMETRY_CAPACITY  # records per file
+        self.keep = TELEMETRY_KEEP if keep is None else keep  # rotated files kept, path.1 is the newest
+        self.size = TELEMETRY_DATA + self.capacity * TELEMETRY_RECORD.size
+        self.file = None
+        self.map = None
+        self.count = 0
+
+    def open(self):
+        # appends to the current file when it has the same layout, starts a new one otherwise
+
+        if os.path.exists(self.path) and os.path.getsize(self.path) == self.size:
+            self.file = open(self.path, 'r+b')
+            self.map = mmap.mmap(self.file.fileno(), self.size)
+            header = TELEMETRY_HEADER.unpack_from(self.map, 0)
+            if header[:3] == (TELEMETRY_MAGIC, TELEMETRY_RECORD.size, self.capacity) and \
+                    header[3].rstrip(b'\0') == TELEMETRY_RECORD.format.encode():
+                self.count = TELEMETRY_COUNT.unpack_from(self.map, TELEMETRY_COUNT_AT)[0]
+                if self.count < self.capacity:
+                    return
+            self.close()
+
+        if os.path.exists(self.path):
+            self.rotate_files()
+        self.create()
+
+    def create(self):
+
+        self.file = open(self.path, 'w+b')
+        # blocks allocated up front, a full disk fails here instead of faulting a later write to the map
+        if hasattr(os, 'posix_fallocate'):
+            os.posix_fallocate(self.file.fileno(), 0, self.size)
+        else:
+            self.file.truncate(self.size)
+        self.map = mmap.mmap(self.file.fileno(), self.size)
+
+        TELEMETRY_HEADER.pack_into(self.map, 0, TELEMETRY_MAGIC, TELEMETRY_RECORD.size, self.capacity,
+                                   TELEMETRY_RECORD.format.encode(), TELEMETRY_FIELDS.encode())
+        self.count = 0
+        TELEMETRY_COUNT.pack_into(self.map, TELEMETRY_COUNT_AT, 0)
+
+    def rotate_files(self):
+        # path -> path.1 -> ... -> path.keep, the oldest one is dropped
+
+        for n in range(self.keep, 0, -1):
+            older = "{}.{}".format(self.path, n)
+            newer = self.path if n == 1 else "{}.{}".format(self.path, n - 1)
+            if os.path.exists(newer):
+                os.replace(newer, older)
+        if self.keep == 0:
+            os.remove(self.path)
+
+    def record(self, *values):
+        # one TELEMETRY_RECORD, packed straight into the map
+
+        if self.count == self.capacity:
+            self.close()
+            self.rotate_files()
+            self.create()
+
+        TELEMETRY_RECORD.pack_into(self.map, TELEMETRY_DATA + self.count * TELEMETRY_RECORD.size, *values)
+        self.count += 1
+        TELEMETRY_COUNT.pack_into(self.map, TELEMETRY_COUNT_AT, self.count)
+
+    def close(self):
+
+        if self.map is not None:
+            self.map.flush()
+            self.map.close()
+            self.map = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class DeviceCache:
+    """Idx-keyed device readings kept between heartbeats, fed by bulk reads and device notifications"""
+
+    def __init__(self):
+        self.devices = {}
+        self.received = {}  # idx -> time the reading was last confirmed
+        self.names = {}  # device Name -> idx, notifications only carry the name
+        self.act_time = None  # ActTime of the last bulk read, for lastupdate= delta reads
+
+    def load(self, result, wanted, now, act_time=None, delta=False):
+        for device in result:
+            idx = int(device['idx'])
+            if idx in wanted:
+                self.update(idx, device, now)
+
+        # a delta read confirms every wanted device it did not return as unchanged
+        if delta:
+            for idx in wanted:
+                if idx in self.devices:
+                    self.received[idx] = now
+
+        if act_time is not None:
+            self.act_time = act_time
+
+    def update(self, idx, device, now):
+        self.devices[idx] = device
+        self.received[idx] = now
+        self.names[device.get('Name')] = idx
+
+    def notify(self, name, text, now):
+        # minimal decoding of a Domoticz notification into the cached device
+
+        idx = self.names.get(name)
+        if idx is None:
+            return None
+
+        # a written valve is dropped from the cache until it is read again
+        cached = self.devices.get(idx)
+        if cached is None:
+            return None
+
+        device = dict(cached)
+        device['LastUpdate'] = now.strftime("%Y-%m-%d %H:%M:%S")
+
+        temp = str(device.get('Type', '')).startswith('Temp')
+        if temp or device.get('Type') == 'Thermostat':
+            # "<device name> ... is 21.5 ..." - the name may hold numbers too, the value follows "is";
+            # without it the last number of the text is taken
+            if temp and re.search(r"\b(humidity|barometer|dew ?point)\s+is\b", text, re.IGNORECASE):
+                return None
+            value = re.search(r"\bis\s*(-?\d+(?:\.\d+)?)", text)
+            if value is None:
+                value = re.search(r"(-?\d+(?:\.\d+)?)\D*$", text)
+            if value is None:
+                return None
+            device['Temp' if temp else 'SetPoint'] = float(value.group(1))
+        else:
+            status = re.search(r"\b(On|Off|Open|Closed)\b", text, re.IGNORECASE)
+            if status is None:
+                return None
+            device['Status'] = status.group().capitalize()
+
+        self.update(idx, device, now)
+        return idx
+
+    def get(self, idx, max_age=None, now=None):
+        if max_age is not None and (idx not in self.received or now - self.received[idx] > max_age):
+            return None
+        return self.devices.get(idx)
+
+    def has_all(self, idx_list):
+        return all(idx in self.devices for idx in idx_list)
+
+    def invalidate(self, idx=None):
+        if idx is None:
+            self.devices = {}
+            self.received = {}
+            self.names = {}
+            self.act_time = None
+        else:
+            self.devices.pop(idx, None)
+            self.received.pop(idx, None)
+
+
+class SharedDeviceCache:
+    """Device readings shared by the SVTP instances of one host, a memory-mapped table of fixed size slots
+
+    Slots are found by idx with linear probing, each holds (idx, time read from the API, length) and the device
+    as compact json. An instance missing an idx registers an empty slot, the bulk reads of every instance then fill
+    it. Every access holds an exclusive flock on the file, and a lock between the threads of the instance.
+    """
+
+    def __init__(self, path, slots=None):
+        self.path = path
+        self.slots = slots or SHARED_SLOTS
+        self.size = SHARED_HEADER.size + self.slots * SHARED_SLOT_SIZE
+        self.file = None
+        self.map = None
+        self.lock = threading.Lock()  # flock does not exclude the threads sharing the file
+
+    def open(self):
+
+        self.file = open(self.path, 'a+b')
+        fcntl.flock(self.file, fcntl.LOCK_EX)
+        try:
+            self.file.seek(0)
+            header = self.file.read(SHARED_HEADER.size)
+            if len(header) < SHARED_HEADER.size or SHARED_HEADER.unpack(header) != (SHARED_MAGIC, self.slots, SHARED_SLOT_SIZE):
+                # new file or another layout - every instance of the host starts over with the same one
+                self.file.truncate(0)
+                self.file.truncate(self.size)
+                self.file.seek(0)
+                self.file.write(SHARED_HEADER.pack(SHARED_MAGIC, self.slots, SHARED_SLOT_SIZE))
+                self.file.flush()
+            self.map = mmap.mmap(self.file.fileno(), self.size)
+        finally:
+            fcntl.flock(self.file, fcntl.LOCK_UN)
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def slot(self, idx, register=False):
+        # offset of the slot of idx, a free one is taken when registering - None when missing or the table is full
+
+        start = idx % self.slots
+        for n in range(self.slots):
+            offset = SHARED_HEADER.size + ((start + n) % self.slots) * SHARED_SLOT_SIZE
+            slot_idx = SHARED_SLOT.unpack_from(self.map, offset)[0]
+            if slot_idx == idx:
+                return offset
+            if slot_idx == 0:
+                if not register:
+                    return None
+                SHARED_SLOT.pack_into(self.map, offset, idx, 0.0, 0)
+                return offset
+        return None
+
+    def read(self, idx_list, max_age, now, known=None):
+        # number of devices read within max_age seconds and {idx: (device, read time)} of those newer than known
+        # (idx -> datetime, the readings of this instance); the missing ones are registered
+
+        fresh, found = 0, {}
+        with self.lock:
+            fcntl.flock(self.file, fcntl.LOCK_EX)
+            try:
+                for idx in idx_list:
+                    offset = self.slot(idx, register=True)
+                    if offset is None:
+                        continue
+                    slot_idx, received, length = SHARED_SLOT.unpack_from(self.map, offset)
+                    if length > 0 and now - received <= max_age:
+                        fresh += 1
+                        # known belongs to the plugin thread, get() does not fail on a concurrent change
+                        last = known.get(idx) if known is not None else None
+                        if last is not None and last.timestamp() >= received:
+                            continue
+                        start = offset + SHARED_SLOT.size
+                        found[idx] = (json.loads(self.map[start:start + length].decode()), received)
+            finally:
+                fcntl.flock(self.file, fcntl.LOCK_UN)
+        return fresh, found
+
+    def write(self, devices, wanted, now, confirm_since=None):
+        # devices read from the API at now, stored when registered by any instance or wanted by this one;
+        # a delta read (confirm_since) also confirms the slots read after its start as unchanged
+
+        written = set()
+        with self.lock:
+            fcntl.flock(self.file, fcntl.LOCK_EX)
+            try:
+                for device in devices:
+                    idx = int(device['idx'])
+                    offset = self.slot(idx, register=idx in wanted)
+                    if offset is None:
+                        continue
+
+                    payload = json.dumps({key: device[key] for key in SHARED_KEYS if key in device},
+                                         separators=(',', ':')).encode()
+                    if SHARED_SLOT.size + len(payload) > SHARED_SLOT_SIZE:
+                        continue
+
+                    # a slower instance does not replace a newer reading
+                    slot_idx, received, length = SHARED_SLOT.unpack_from(self.map, offset)
+                    if length > 0 and received > now:
+                        continue
+
+                    SHARED_SLOT.pack_into(self.map, offset, idx, now, len(payload))
+                    start = offset + SHARED_SLOT.size
+                    self.map[start:start + len(payload)] = payload
+                    written.add(idx)
+
+                if confirm_since is not None:
+                    for n in range(self.slots):
+                        offset = SHARED_HEADER.size + n * SHARED_SLOT_SIZE
+                        slot_idx, received, length = SHARED_SLOT.unpack_from(self.map, offset)
+                        if slot_idx != 0 and length > 0 and slot_idx not in written and confirm_since <= received < now:
+                            SHARED_SLOT.pack_into(self.map, offset, slot_idx, now, length)
+            finally:
+                fcntl.flock(self.file, fcntl.LOCK_UN)
+
+    def invalidate(self, idx_list):
+        # after writes to the devices, the next reader fetches them from the API
+
+        with self.lock:
+            fcntl.flock(self.file, fcntl.LOCK_EX)
+            try:
+                for idx in idx_list:
+                    offset = self.slot(idx)
+                    if offset is not None:
+                        slot_idx, received, length = SHARED_SLOT.unpack_from(self.map, offset)
+                        SHARED_SLOT.pack_into(self.map, offset, idx, 0.0, length)
+            finally:
+                fcntl.flock(self.file, fcntl.LOCK_UN)
+
+
+class SensorHistory:
+    """Fixed size ring buffer of one sensor readings (value, LastUpdate epoch) with a running window sum
+    and the least squares sums of its last readings for the temperature slope"""
+
+    def __init__(self, size=16, trend=4):
+        self.size = size
+        self.values = array('d', bytes(8 * size))
+        self.times = array('d', bytes(8 * size))
+        self.head = 0  # next slot
+        self.count = 0
+        self.total = 0.0
+        self.last_raw = None  # LastUpdate string of the last reading, saves parsing unchanged values
+
+        # sums of t, v, t*t and t*v over the last trend readings, t relative to origin keeps them small
+        self.trend = min(trend, size)
+        self.trend_count = 0
+        self.origin = None
+        self.sum_t = self.sum_v = self.sum_tt = self.sum_tv = 0.0
+
+    def add(self, value, timestamp):
+        # False for a reading already recorded
+
+        if self.count > 0 and timestamp <= self.times[self.head - 1]:
+            return False
+
+        if self.origin is None:
+            self.origin = timestamp
+
+        # the oldest reading of the slope window leaves it, before its slot can be reused
+        if self.trend_count == self.trend:
+            self._trend(self.times[self.head - self.trend], self.values[self.head - self.trend], -1.0)
+        else:
+            self.trend_count += 1
+        self._trend(timestamp, value, 1.0)
+
+        if self.count == self.size:
+            self.total -= self.values[self.head]
+        else:
+            self.count += 1
+
+        self.values[self.head] = value
+        self.times[self.head] = timestamp
+        self.total += value
+        self.head = (self.head + 1) % self.size
+
+        # no drift of the running sums over long runs
+        if self.head == 0:
+            self.total = sum(self.values[:self.count])
+            self.origin = timestamp
+            self.trend_count = 0
+            self.sum_t = self.sum_v = self.sum_tt = self.sum_tv = 0.0
+            for i in range(self.size - self.trend, self.size):
+                if i >= self.size - self.count:
+                    self.trend_count += 1
+                    self._trend(self.times[i], self.values[i], 1.0)
+        return True
+
+    def _trend(self, timestamp, value, sign):
+        t = timestamp - self.origin
+        self.sum_t += sign * t
+        self.sum_v += sign * value
+        self.sum_tt += sign * t * t
+        self.sum_tv += sign * t * value
+
+    def last(self):
+        return self.values[self.head - 1]
+
+    def last_time(self):
+        return self.times[self.head - 1]
+
+    def mean(self):
+        return self.total / self.count
+
+    def slope(self):
+        # (degrees per minute, seconds covered) of the last readings, None with less than 3 of them
+
+        n = self.trend_count
+        if n < 3:
+            return None
+
+        spread = n * self.sum_tt - self.sum_t * self.sum_t
+        if spread <= 0.0:
+            return None
+
+        span = self.times[self.head - 1] - self.times[self.head - n]
+        return 60.0 * (n * self.sum_tv - self.sum_t * self.sum_v) / spread, span
+
+
+def aggregate_temps(mode, readings, timeout):
+    """Room temperature from (value, age in seconds) readings of the fresh sensors"""
+
+    values = [value for value, age in readings]
+
+    if mode == SENSORS_MIN:
+        return min(values)
+    if mode == SENSORS_MAX:
+        return max(values)
+    if mode == SENSORS_MEDIAN:
+        values.sort()
+        middle = len(values) // 2
+        return values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2.0
+    if mode == SENSORS_WEIGHTED:
+        # a reading close to the timeout counts little, never nothing
+        weights = [max(0.05, 1.0 - age / timeout) for value, age in readings]
+        return sum(value * weight for value, weight in zip(values, weights)) / sum(weights)
+
+    return sum(values) / len(values)
+
+
+class WakeTracker:
+    """Learns the wake up interval of a battery valve from its LastUpdate history"""
+
+    def __init__(self, history=8):
+        self.last_raw = None  # LastUpdate string last seen, saves parsing unchanged values
+        self.last = None  # last wake up
+        self.sent = None  # last setpoint write, Domoticz updates LastUpdate on commands too
+        self.intervals = deque(maxlen=history)
+        self.interval = None  # learned wake up interval in seconds
+        self.polls = 0  # device reads requested for learning
+
+    def observe(self, last_update_raw):
+
+        if last_update_raw == self.last_raw:
+            return
+        self.last_raw = last_update_raw
+
+        last_update = ParseDateTime(last_update_raw)
+        if self.last is not None and last_update <= self.last:
+            return
+
+        # an update right after our own write is the command echo, not a wake up
+        if self.sent is not None and abs((last_update - self.sent).total_seconds()) < WAKE_ECHO:
+            return
+
+        if self.last is not None:
+            interval = (last_update - self.last).total_seconds()
+
+            if interval >= WAKE_MIN:
+                self.intervals.append(interval)
+
+                # LastUpdate is only seen when SVTP reads the devices, wake ups in between make multiples
+                # of the interval - they are scaled down by the shortest one before taking the median
+                shortest = min(self.intervals)
+                scaled = sorted(interval / round(interval / shortest) for interval in self.intervals)
+                self.interval = scaled[len(scaled) // 2]
+
+        self.last = last_update
+
+    def predict(self, after):
+        # first expected wake up at or after the given time, None while the interval is unknown
+
+        if self.interval is None or len(self.intervals) < WAKE_SAMPLES:
+            return None
+
+        periods = max(0, math.ceil((after - self.last).total_seconds() / self.interval))
+        return self.last + timedelta(seconds=periods * self.interval)
+
+
+class TokenBucket:
+    """Valve commands allowed on the radio network: a rate per minute with a burst"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate / 60.0  # tokens per second, 0 - unlimited
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = None
+
+    def refill(self, now):
+        if self.updated is not None:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated).total_seconds() * self.rate)
+        self.updated = now
+
+    def take(self, now):
+
+        if self.rate <= 0:
+            return True
+
+        self.refill(now)
+        if self.tokens >= 1.0:
+            self.tokens -= 1.0
+            return True
+        return False
+
+    def next_token(self, now):
+        if self.rate <= 0 or self.tokens >= 1.0:
+            return now
+        return now + timedelta(seconds=(1.0 - self.tokens) / self.rate)
+
+
+class Zone:
+    """One controlled room: its devices, setpoints and PID state"""
+
+    def __init__(self, index, internals_defaults):
+
+        self.index = index
+        self.unit = index + 1  # Thermostat Mode selector of the zone
+
+        self.in_temp_sensors = []
+        self.open_window_sensors = []
+        self.radiators = []
+
+        self.high_temp = 21.0
+        self.low_temp = 20.0
+        self.pause_temp = 5.0
+
+        self.Internals = internals_defaults.copy()
+        self.saved_internals = None  # last Internals written to Domoticz
+        self.started_internals = None  # Internals at the end of onStart, until the stored ones are reconciled
+        self.save_due = None
+        self.state_store = None
+        self.state_cache = None  # local copy of the user variable
+        self.loading = False  # no local state, calculations wait for the user variable
+        self.load_pending = False
+
+        self.next_calc = datetime.now()
+        self.last_calc = None
+        self.current_temp = None  # room temperature of the last calculation
+        self.heatup = None  # (start, temperature) of a running switch to Normal, for the heat-up rate
+        self.window_due = None  # end of a running pause on / pause off delay or next window sensors poll
+        self.drop = False  # open window inferred from a temperature drop
+        self.drop_changed = None  # time the drop started / ended
+        self.drop_holdoff = None  # no drop is detected before this time
+        self.waited = False  # calculation postponed for a sensor read
+        self.used_reading = None  # (newest reading time, target) of the last PID update
+        self.mode = 0  # Thermostat Mode nValue, kept in sync by onStart / onCommand
+        self.enabled = True
+        self.reset_cnt = 0 # Pause -> Off -> True
+        self.reload_cnt = 0 # Off -> Pause & step1 -> True
+
+    def suffix(self):
+        # the first zone keeps the user variable and state file names of single room installs
+        return "" if self.index == 0 else "-Zone{}".format(self.index + 1)
+
+
+# statuses returned by compute_shifts
+CALC_DONE = 0
+CALC_SKIP_PREC = 1
+CALC_SKIP_MAX_SHIFT = 2
+
+
+def compute_shifts(mode, Kp, Ki, Kd, max_shift, sensor_prec, target, current, integral, previous_error, current_delta):
+    """Batched PID / simple delta update of every zone due, on array-backed columns updated in place
+
+    Returns the per-zone status (CALC_*) and derivative arrays.
+    """
+
+    count = len(target)
+    status = array('b', bytes(count))
+    derivative = array('d', bytes(8 * count))
+
+    for i in range(count):
+
+        if abs(current[i] - target[i]) <= sensor_prec * 2.0:
+            status[i] = CALC_SKIP_PREC
+            continue
+
+        if mode == 1: # PID
+
+            error = round(target[i] - current[i], 2)
+
+            if abs(current_delta[i]) == max_shift:
+
+                if (current_delta[i] < 0 and error < 0 and error <= previous_error[i]) or \
+                    (current_delta[i] > 0 and error > 0 and error >= previous_error[i]):
+
+                    status[i] = CALC_SKIP_MAX_SHIFT
+                    continue
+
+            integral[i] = round(integral[i] + error, 2)
+            derivative[i] = round(error - previous_error[i], 2)
+
+            pid_p = round(Kp * error, 2)
+            pid_i = round(Ki * integral[i], 2)
+            pid_d = round(Kd * derivative[i], 2)
+
+            temp_shift = round(pid_p + pid_i + pid_d, 1)
+            previous_error[i] = error
+
+        elif mode == 2: # simple delta
+
+            temp_shift = round(target[i] - current[i], 1)
+
+        else:
+            continue
+
+        if abs(temp_shift) > max_shift:
+
+            if temp_shift > 0:
+                temp_shift = max_shift
+            else:
+                temp_shift = -1.0 * max_shift
+
+        current_delta[i] = temp_shift
+
+    return status, derivative
+
+
 class BasePlugin:
 
     def __init__(self):
 
         self.calculate_period = 10  # Time in minutes between two calculations (cycle)
         self.pause_on_delay = 1  # time between pause sensor actuation and actual pause
-        self.pauseoffdelay = 10  # time between end of pause sensor actuation and end of actual pause
+        self.pause_off_delay = 10  # time between end of pause sensor actuation and end of actual pause
         
-        self.in_temp_sensors = []
-        self.radiators = []
-        self.open_window_sensors = []
+        self.zones = []
+        self.zones_by_unit = {}
+        self.wanted = set()  # idx of every sensor and valve of every zone
+        self.cache = DeviceCache()
+        self.shared = None  # SharedDeviceCache of the SVTP instances using the same Domoticz
+        self.shared_dir = SHARED_DIR  # folder of the shared device cache file
+        self.api = None
+        self.worker = None
+        self.devices_pending = False
+        self.devices_checked = False  # zone devices validated by the first bulk read
+        self.write_pool_size = 4  # valve setpoints of one heartbeat are posted concurrently
+        self.commanded = {}  # idx -> (setpoint, addjvalue, time) last commanded by SVTP
+        self.wakes = {}  # valve idx -> WakeTracker
+        self.history = {}  # temperature sensor idx -> SensorHistory
+        self.sensors_mode = SENSORS_AVG
+        self.pending = {}  # valve idx -> (priority, due, params), the latest write not sent yet
+        self.held = set()  # pending writes held back by the rate limits, for the stats
+        self.last_write = {}  # valve idx -> time of the last write sent
+        self.write_bucket = TokenBucket(10, 10)  # valve writes per minute / burst, shared by all zones
+        self.valve_min_interval = 120  # seconds between two PID adjustments of one valve
+        self.setpoint_cache_ttl = 60  # minutes before a commanded setpoint is read back from the valve
         
         self.InternalsDefaults = {
             'previous_error': float(0.0),  
@@ -57,14 +1130,31 @@ class BasePlugin:
             'current_delta': float(0.0),
             'target_temp': float(-100.0),
             'opened_window': int(0),
-            'nValue': int(0)
+            'nValue': int(0),
+            'heat_rate': float(0.0)  # learned heat-up in degrees per hour, 0 - unknown
             }
         
-        self.Internals = self.InternalsDefaults.copy()
+        self.save_interval = 15  # minutes during which Internals changes are coalesced into one write
+        self.metrics = None  # Metrics when enabled by Mode6 M
+        self.metrics_mode = 0  # 0 - off, 1 - summary log line, 2 - summary log line and devices
+        self.metrics_interval = 60  # minutes between two summaries
+        self.metrics_due = None
+        self.next_deadline = None  # no heartbeat work before, None - evaluate the next heartbeat
+        self.budget_end = None  # perf_counter time the running heartbeat has to finish its work by
+        self.carried_over = False  # the last heartbeat left work for the next one
+        self.api_suspended = False  # the circuit breaker opening was logged
+        self.heartbeat_interval = 10  # seconds, Domoticz default
+        self.window_sensors = set()
+        self.windows = {}  # window sensor idx -> (opened, time of the last state change)
+        self.sensor_zones = {}  # temperature sensor idx -> zones using it, for the drop detection
+        self.state_backend = 1  # 1 - Domoticz user variable, 2 - local file in the plugin home folder
+        self.telemetry_mode = 0  # 1 - calculations recorded by TelemetryRecorder
+        self.events = []  # heap of (due, seq, kind, args) - weekly schedule, preheat and valve exercise
+        self.event_seq = itertools.count()  # ties of the heap
+        self.exercising = set()  # valves closed by the exercise, left alone by set_target_temp
+        self.telemetry = None
         
         
-        self.high_temp = 21.0
-        self.low_temp = 20.0 
         self.trv_prec_temp = 0.5
         self.sensor_prec_temp = 0.1
         self.max_shift = 2.0 
@@ -75,16 +1165,13 @@ class BasePlugin:
         self.Ki = 0.1
         self.Kd = 0.2
         
+        self.debug = 0
         self.shift_calc_mode = 1 # PID
         self.trv_control = 1 # setpoint
         self.temp_sensors_timeout = 90
 
-        self.next_calc = datetime.now()
-        self.last_calc = None
         # self.last_command = None
         self.enabled = True
-        self.reset_cnt = 0 # Pause -> Off -> True
-        self.reload_cnt = 0 # Off -> Pause & step1 -> True
  
         
 
@@ -92,144 +1179,252 @@ class BasePlugin:
     def onStart(self):
 
         domoticz.Debugging(1)
-        DumpConfigToLog()
+
+        self.api = DomoticzAPI(Parameters.get("Address") or '127.0.0.1', Parameters.get("Port") or '8080')
+
+        # listed as a notification system, device notifications sent to it arrive in onNotification
+        domoticz.Notifier(Parameters["Name"])
         
-        # Load config params
-        self.in_temp_sensors = parseCSV(Parameters["Mode1"], 'in_temp_sensors', 'int')
-        self.check_params(self.in_temp_sensors, 1, "in_temp_sensors")            
+        # Load config params - zones are separated by ';'
+        in_temp_sensors = parseZonesCSV(Parameters["Mode1"], 'in_temp_sensors', 'int')
+        self.check_params(in_temp_sensors, 1, "in_temp_sensors")            
 
-        self.open_window_sensors = parseCSV(Parameters["Mode2"], 'open_window_sensors', 'int')
-        self.check_params(self.open_window_sensors, 0, "open_window_sensors")
+        open_window_sensors = parseZonesCSV(Parameters["Mode2"], 'open_window_sensors', 'int')
+        self.check_params(open_window_sensors, 0, "open_window_sensors")
         
-        self.radiators = parseCSV(Parameters["Mode3"], 'radiators', 'int')
-        self.check_params(self.radiators, 1, "radiators")
+        radiators = parseZonesCSV(Parameters["Mode3"], 'radiators', 'int')
+        self.check_params(radiators, len(in_temp_sensors or []), "radiators")
         
-        temp_params = parseCSV(Parameters["Mode4"], 'temp_params', 'float')
-        self.check_params(temp_params, 5, "temp_params")
+        temp_params = parseZonesCSV(Parameters["Mode4"], 'temp_params', 'float')
+        self.check_params(temp_params, 1, "temp_params")
         
         time_params = parseCSV(Parameters["Mode5"], 'time_params', 'int')
         self.check_params(time_params, 4, "time_params")
         
         pid_params = parseCSV(Parameters["Mode6"], 'pid_params', 'float')
         self.check_params(pid_params, 6, "pid_params")
+
+        if self.enabled is False:
+            logger.error("Invalid parameters - SVTP is disabled")
+            return
+
+        for index, sensors in enumerate(in_temp_sensors):
+            zone = Zone(index, self.InternalsDefaults)
+            zone.in_temp_sensors = sensors
+            zone.open_window_sensors = open_window_sensors[index] if index < len(open_window_sensors) else []
+            zone.radiators = radiators[index]
+            self.check_params(zone.in_temp_sensors, 1, "in_temp_sensors zone {}".format(zone.unit))
+            self.check_params(zone.radiators, 1, "radiators zone {}".format(zone.unit))
+            self.zones.append(zone)
+            self.zones_by_unit[zone.unit] = zone
+            self.wanted.update(itertools.chain(zone.in_temp_sensors, zone.open_window_sensors, zone.radiators))
+            self.window_sensors.update(zone.open_window_sensors)
+            for idx in zone.radiators:
+                self.wakes[idx] = WakeTracker()
+            for idx in zone.in_temp_sensors:
+                self.history[idx] = SensorHistory()
+                self.sensor_zones.setdefault(idx, []).append(zone)
         
-        if len(temp_params) == 6:
-            self.high_temp = temp_params[0]
-            self.low_temp = temp_params[1]
-            self.pause_temp = temp_params[2]
-            self.trv_prec_temp = temp_params[3]
-            self.sensor_prec_temp = temp_params[4]
-            self.max_shift = temp_params[5]
+        if len(temp_params[0]) == 6:
+            self.trv_prec_temp = temp_params[0][3]
+            self.sensor_prec_temp = temp_params[0][4]
+            self.max_shift = temp_params[0][5]
+
+            # High/Low/Pause may be given per zone, missing values come from the first zone
+            for zone in self.zones:
+                zone_temps = temp_params[zone.index] if zone.index < len(temp_params) else []
+                zone_temps = zone_temps[:3] + temp_params[0][len(zone_temps):3]
+                zone.high_temp, zone.low_temp, zone.pause_temp = zone_temps
         else:
-            domoticz.Error("Error reading Mode4 parameters")
+            logger.error("Error reading Mode4 parameters")
             
  
         
-        if len(time_params) == 4:
+        if len(time_params) in (4, 5):
             self.calculate_period = time_params[0]
             
             if self.calculate_period < 3:
-                domoticz.Error("Invalid calculation period parameter. Using minimum of 3 minutes !")
+                logger.error("Invalid calculation period parameter. Using minimum of 3 minutes !")
                 self.calculate_period = 3
            
             self.pause_on_delay = time_params[1]
-            self.pauseoffdelay = time_params[2]
+            self.pause_off_delay = time_params[2]
             self.temp_sensors_timeout = time_params[3]
+
+            if len(time_params) == 5:
+                self.save_interval = time_params[4]
            
         else:
-            domoticz.Error("Error reading Mode5 parameters")
+            logger.error("Error reading Mode5 parameters")
             
         
-        if len(pid_params) == 6:
+        if len(pid_params) >= 6:
             self.Kp = pid_params[0]
             self.Ki = pid_params[1]
             self.Kd = pid_params[2]
             self.debug = int(pid_params[3])
             self.shift_calc_mode = int(pid_params[4])
             self.trv_control = int(pid_params[5])
+
+            if len(pid_params) > 6:
+                self.state_backend = int(pid_params[6])
+            if len(pid_params) > 7:
+                self.metrics_mode = int(pid_params[7])
+            if len(pid_params) > 8:
+                self.sensors_mode = int(pid_params[8])
+            if len(pid_params) > 9:
+                self.telemetry_mode = int(pid_params[9])
             domoticz.Debugging(self.debug)
+            logger.debugging = self.debug != 0
+
+            # walks every parameter and device, only worth it when debugging
+            if self.debug:
+                DumpConfigToLog()
         else:
-            domoticz.Error("Error reading Mode6 parameters")
+            logger.error("Error reading Mode6 parameters")
             
             
-        # control of devices
-        
-        # TODO check devices onHeartbeat
-        for i_dev in itertools.chain(self.in_temp_sensors, self.radiators):
-            if self.get_device_status(i_dev) is None:
-                domoticz.Debug("Device {} is not present - turning off SVTP".format(i_dev))
-                self.enabled = False
-                
-        
+        if self.metrics_mode > 0:
+            self.metrics = Metrics()
+            self.api.metrics = self.metrics
+            self.metrics_due = datetime.now() + timedelta(minutes=self.metrics_interval)
+            if self.metrics_mode == 2:
+                self.create_metrics_devices()
+
+        if self.telemetry_mode > 0:
+            self.telemetry = TelemetryRecorder(os.path.join(Parameters["HomeFolder"], "svtp-{}.telemetry".format(
+                Parameters.get("HardwareID", Parameters["Name"]))))
+            try:
+                self.telemetry.open()
+            except (OSError, ValueError) as e:
+                logger.error("Cannot open the telemetry file {}: {}", self.telemetry.path, e)
+                self.telemetry.close()
+                self.telemetry = None
+
+        # from now on every Domoticz API call is queued on the I/O worker, onStart does not wait for any
+        self.worker = IOWorker(self.api)
+        self.worker.start()
+
+        if fcntl is not None:
+            address = re.sub(r'[^\w.-]', '_', "{}-{}".format(Parameters.get("Address") or '127.0.0.1', Parameters.get("Port") or '8080'))
+            self.shared = SharedDeviceCache(os.path.join(self.shared_dir, "svtp-devices-{}".format(address)))
+            try:
+                self.shared.open()
+            except (OSError, ValueError) as e:
+                logger.error("Cannot open the shared device cache {}: {}", self.shared.path, e)
+                self.shared.close()
+                self.shared = None
+
+        # control of devices: one bulk read, checked by validate_devices before the first calculation
+        self.refresh_devices()
+
         # create the child devices if these do not exist yet
-        if 1 not in Devices:
-            Options = {"LevelActions": "||",
-                       "LevelNames": "Off|Normal|Economy|Pause",
-                       "LevelOffHidden": "false",
-                       "SelectorStyle": "0"}
-            domoticz.Device(Name="Thermostat Mode", Unit=1, TypeName="Selector Switch", Switchtype=18, Image=15,
-                            Options=Options, Used=1).Create()
+        for zone in self.zones:
+            if zone.unit not in Devices:
+                Options = {"LevelActions": "||",
+                           "LevelNames": "Off|Normal|Economy|Pause",
+                           "LevelOffHidden": "false",
+                           "SelectorStyle": "0"}
+                name = "Thermostat Mode" if zone.index == 0 else "Thermostat Mode {}".format(zone.unit)
+                domoticz.Device(Name=name, Unit=zone.unit, TypeName="Selector Switch", Switchtype=18, Image=15,
+                                Options=Options, Used=1).Create()
             
         
-        self.load_internals()
+            self.load_internals(zone)
+        
+            # if any device has been created in onStart(), now is time to update its defaults
+            self.apply_mode(zone)
+            zone.started_internals = zone.Internals.copy()
+
+            logger.log("Zone {}: {}", zone.unit, zone.Internals)
+
+        self.load_schedule(os.path.join(Parameters["HomeFolder"], "svtp-{}.schedule".format(
+            Parameters.get("HardwareID", Parameters["Name"]))), datetime.now())
+
+        self.schedule(datetime.now())
+        
         
-        # if any device has been created in onStart(), now is time to update its defaults
-        if self.Internals["nValue"] == 0:
+        
+    
+  
+
+    def apply_mode(self, zone):
+        # Thermostat Mode device and target temperature from the Internals nValue
+
+        if zone.Internals["nValue"] == 0:
             nvalue = 0
             svalue = "0"
-            
-        elif self.Internals["nValue"] == 1:
+
+        elif zone.Internals["nValue"] == 1:
             nvalue = 1
             svalue = "10"
-            self.Internals["target_temp"] = self.high_temp
-            
-        elif self.Internals["nValue"] == 2:
+            zone.Internals["target_temp"] = zone.high_temp
+
+        elif zone.Internals["nValue"] == 2:
             nvalue = 2
             svalue = "20"
-            self.Internals["target_temp"] = self.low_temp
-        
-        elif self.Internals["nValue"] == 3:
+            zone.Internals["target_temp"] = zone.low_temp
+
+        elif zone.Internals["nValue"] == 3:
             nvalue = 3
             svalue = "30"
-            self.Internals["target_temp"] = self.pause_temp
-            
+            zone.Internals["target_temp"] = zone.pause_temp
+
         else:
-            domoticz.Error("onStart: Unknown Internals nValue: {}".format(self.Internals["nValue"]))
-            
-        Devices[1].Update(nValue=nvalue, sValue=svalue)
-        
-        domoticz.Log(str(self.Internals))
-        
-        
-        
-    
-  
+            logger.error("onStart: Unknown Internals nValue: {}", zone.Internals["nValue"])
+            nvalue = 0
+            svalue = "0"
+
+        Devices[zone.unit].Update(nValue=nvalue, sValue=svalue)
+        zone.mode = nvalue
+
 
     def onStop(self):
 
+        for zone in self.zones:
+            self.flush_internals(zone)
+
+        if self.worker is not None:
+            self.worker.stop()
+            self.process_completions()
+            self.worker = None
+
+        if self.api is not None:
+            self.api.close()
+        if self.telemetry is not None:
+            self.telemetry.close()
+            self.telemetry = None
+        if self.shared is not None:
+            self.shared.close()
+            self.shared = None
         domoticz.Debugging(0)
 
 
     def onCommand(self, Unit, Command, Level, Color):
 
-        domoticz.Log("onCommand called for Unit {}: Command '{}', Level: {}".format(Unit, Command, Level))
+        logger.log("onCommand called for Unit {}: Command '{}', Level: {}", Unit, Command, Level)
+
+        zone = self.zones_by_unit.get(Unit)
+        if zone is None:
+            logger.error("onCommand: no zone for Unit {}", Unit)
+            return
         
         if Command == "Off":
         
             nvalue = 0
-            self.reset_cnt = 0
-            self.reload_cnt += 1
+            zone.reset_cnt = 0
+            zone.reload_cnt += 1
             
-            if self.reload_cnt == 1:
+            if zone.reload_cnt == 1:
             
-                self.Internals["target_temp"] = -100.0
-                self.save_internals()
+                zone.Internals["target_temp"] = -100.0
+                self.save_internals(zone, force=True)
             
-            elif self.reload_cnt == 3:
+            elif zone.reload_cnt == 3:
                 
-                self.load_internals()
-                domoticz.Log("load_internals")
-                self.reload_cnt = 0
+                self.load_internals(zone)
+                logger.log("load_internals")
+                zone.reload_cnt = 0
                     
             
             
@@ -239,238 +1434,729 @@ class BasePlugin:
             
             
             if Level == 10:
-                self.Internals["target_temp"] = self.high_temp
-                self.Internals["nValue"] = 1
+                zone.Internals["target_temp"] = zone.high_temp
+                zone.Internals["nValue"] = 1
                 nvalue = 1
-                self.save_internals()
-                self.set_target_temp(self.high_temp, self.Internals["current_delta"], force=True)
-                self.reset_cnt = 0
-                self.reload_cnt = 0
+                self.save_internals(zone, force=True)
+                self.set_target_temp(zone, zone.high_temp, zone.Internals["current_delta"], force=True)
+                self.start_heatup(zone, datetime.now())
+                zone.reset_cnt = 0
+                zone.reload_cnt = 0
 
             elif Level == 20:
-                self.Internals["target_temp"] = self.low_temp
-                self.Internals["nValue"] = 2
+                zone.Internals["target_temp"] = zone.low_temp
+                zone.Internals["nValue"] = 2
                 nvalue = 2
-                self.save_internals()
-                self.set_target_temp(self.low_temp, self.Internals["current_delta"], force=True)
-                self.reset_cnt = 0
-                self.reload_cnt = 0
+                self.save_internals(zone, force=True)
+                self.set_target_temp(zone, zone.low_temp, zone.Internals["current_delta"], force=True)
+                zone.reset_cnt = 0
+                zone.reload_cnt = 0
                 
                 
             elif Level == 30:
             
                 nvalue = 3 
-                self.reload_cnt = 0
-                self.reset_cnt += 1
+                zone.reload_cnt = 0
+                zone.reset_cnt += 1
                 
-                if self.reset_cnt == 1:
-                    self.Internals["target_temp"] = self.pause_temp
-                    self.Internals["nValue"] = 3
-                    self.set_target_temp(self.pause_temp, 0, force=True)
-                    self.save_internals()
-                    domoticz.Debug("Pause is On")
+                if zone.reset_cnt == 1:
+                    zone.Internals["target_temp"] = zone.pause_temp
+                    zone.Internals["nValue"] = 3
+                    self.set_target_temp(zone, zone.pause_temp, 0, force=True)
+                    self.save_internals(zone, force=True)
+                    logger.debug("Pause is On")
                     
-                elif self.reset_cnt == 3:
-                    self.Internals = self.InternalsDefaults.copy()
-                    self.Internals["nValue"] = 3
-                    self.Internals["target_temp"] = self.pause_temp
-                    self.save_internals()
-                    domoticz.Log("InternalsReset")
-                    self.reset_cnt = 0
+                elif zone.reset_cnt == 3:
+                    zone.Internals = self.InternalsDefaults.copy()
+                    zone.Internals["nValue"] = 3
+                    zone.Internals["target_temp"] = zone.pause_temp
+                    self.save_internals(zone, force=True)
+                    logger.log("InternalsReset")
+                    zone.reset_cnt = 0
                 
                 
                 
             else:
-                domoticz.Error("Unknown Level {} onCommand {}".format(Level, Command))
+                logger.error("Unknown Level {} onCommand {}", Level, Command)
+                return
                 
+        self.flush_writes()
         Devices[Unit].Update(nValue=nvalue, sValue=str(Level))
+        zone.mode = nvalue
+        self.schedule(datetime.now())
+
+
+    def onNotification(self, Name, Subject, Text, Status, Priority, Sound, ImageFile):
+
+        # devices notifying SVTP update the cache without waiting for a poll
+        idx = self.cache.notify(Name, Text, datetime.now())
+        if idx is not None:
+            logger.debug("onNotification device {} ({}): {}", idx, Name, Text)
+            self.record_sensors()
+
+            # a window change is acted on by the next heartbeat, not at the next calculation
+            if idx in self.window_sensors:
+                self.wake()
 
 
     def onHeartbeat(self):
-    
-        # TODO: once a week valve full closure
 
-        if self.enabled is False:
+        now = datetime.now()
+
+        # most heartbeats: no deadline reached and no I/O result to pick up
+        if self.next_deadline is not None and now < self.next_deadline and \
+                (self.worker is None or not self.worker.has_completions()):
+            if self.metrics is not None:
+                self.metrics.incr('heartbeat.idle')
             return
-            
-        if Devices[1].nValue in (0, 3):
+
+        if self.metrics is None:
+            self.heartbeat(now)
+        else:
+            started = time.perf_counter()
+            self.heartbeat(now)
+            self.metrics.observe('heartbeat', 1000.0 * (time.perf_counter() - started))
+
+            if self.metrics_due <= now:
+                self.report_metrics()
+
+        self.schedule(now)
+
+
+    def heartbeat(self, now):
+
+        self.budget_end = time.perf_counter() + HEARTBEAT_BUDGET
+        self.carried_over = False
+        try:
+            self.heartbeat_work(now)
+        finally:
+            self.budget_end = None
+
+
+    def heartbeat_work(self, now):
+
+        self.process_completions()
+
+        # while Domoticz does not answer, the cached readings and the current valve set points are kept
+        # and a device read probes it once the breaker cooldown has passed
+        available = self.api_available(now)
+        if not available:
+            self.refresh_devices()
+
+        for zone in self.zones:
+            if zone.save_due is not None and zone.save_due <= now and (available or self.state_backend == 2):
+                self.flush_internals(zone)
+    
+        if self.enabled is False:
             return
-        
-        now = datetime.now()
-        
+
         # fool proof checking.... based on users feedback
-        # if not all(device in Devices for device in (1,)):
-        #    domoticz.Error("One or more devices required by the plugin is/are missing, please check domoticz device creation settings and restart !")
-        #    self.enabled = False
-        #    return
-            
-        opened_window, opened_window_time = self.get_window_data()
-           
-        if self.Internals["opened_window"] == 0 and opened_window == 1 and opened_window_time + timedelta(minutes=self.pause_on_delay) <= now:  
-           
-            domoticz.Log("Opened window - set pause temp {}".format(self.pause_temp))
-            
-            self.Internals["opened_window"] = 1
-            self.set_target_temp(self.pause_temp, 0.0, force=True)
-            
-            
-            
-            self.last_calc = now
-            self.next_calc = now + timedelta(minutes=self.calculate_period /2)
-           
-        elif self.Internals["opened_window"] == 1 and opened_window == 0 and opened_window_time + timedelta(minutes=self.pause_off_delay) <= now:
-           
-            
-            self.Internals["opened_window"] = 0
+        if not self.devices_checked:
+            # the startup bulk read failed or is still running - nothing is controlled before it validated the devices
+            self.refresh_devices()
+            return
 
-            domoticz.Log("Closed window - set {} {}/{}".format(self.Internals["target_temp"], applied_temp))
-            
-            self.set_target_temp(self.Internals["target_temp"], self.Internals["current_delta"], force=True)
-            
-            
-            self.last_calc = now
-            self.next_calc = now + timedelta(minutes=self.calculate_period)
-            
-        elif self.next_calc <= now:  # we start a new calculation
+        # scheduled mode changes and valve exercise
+        if len(self.events) > 0 and self.events[0][0] <= now:
+            self.run_events(now)
 
-            # TODO: implement sensors timeout -> switch to TRV only sensor
-            current_temp = self.get_current_temp()
+        due = []
+        for zone in self.zones:
 
-            if abs(current_temp - self.Internals["target_temp"]) <= self.sensor_prec_temp * 2.0:
-                
-                domoticz.Debug("Skipping calc - current_temp {}, target_temp {}, prec ".format(current_temp, self.Internals["target_temp"], self.sensor_prec_temp))
-                
-                self.last_calc = now
-                self.next_calc = now + timedelta(minutes=self.calculate_period)
-                return
-                
-            
-            # PID    
-            elif self.shift_calc_mode == 1: # PID
-            
-                error = round(self.Internals["target_temp"] - current_temp, 2)
-                
-                if abs(self.Internals["current_delta"]) == self.max_shift:
-                    
-                    if (self.Internals["current_delta"] < 0 and error < 0 and error <= self.Internals["previous_error"]) or \
-                        (self.Internals["current_delta"] > 0 and error > 0 and error >= self.Internals["previous_error"]):
-                    
-                        self.last_calc = now
-                        self.next_calc = now + timedelta(minutes=self.calculate_period)
-                        domoticz.Log("Skipping calc - max_shift reached")
-                        return
-                
-                
-                self.Internals["integral"] = round(self.Internals["integral"] + error, 2)
-                derivative = round(error - self.Internals["previous_error"], 2)
-                
-                pid_p = round(self.Kp * error, 2)
-                pid_i = round(self.Ki * self.Internals["integral"], 2)
-                pid_d = round(self.Kd * derivative, 2)
-                
-                temp_shift = round(pid_p + pid_i + pid_d, 1)
-                    
-                if abs(temp_shift) > self.max_shift:
-                
-                    if temp_shift > 0:
-                        temp_shift = self.max_shift
-                    else:
-                        temp_shift = -1.0 * self.max_shift
-                
-                self.Internals["current_delta"] = temp_shift
-                self.Internals["previous_error"] = error
+            if len(due) > 0 and self.over_budget():
+                break
 
-                domoticz.Debug("PID current_temp {}, target_temp {}, temp_shift {}, p {}, i {}, d {}".format(current_temp, self.Internals["target_temp"], self.Internals["current_delta"], error, self.Internals["integral"], derivative))
-            
-            elif self.shift_calc_mode == 2: # simple delta
-            
-                temp_shift = round(self.Internals["target_temp"] - current_temp, 1)
-                
-                if abs(temp_shift) > self.max_shift:
-                
-                    if temp_shift > 0:
-                        temp_shift = self.max_shift
-                    else:
-                        temp_shift = -1.0 * self.max_shift
-                    
-                self.Internals["current_delta"] = temp_shift
-                
-                domoticz.Debug("SD current_temp {}, temp_shift {}".format(current_temp, temp_shift))
+            if zone.loading:
+                # no state yet - the user variable read failed, retried until it answers
+                if not zone.load_pending and available:
+                    self.load_internals(zone)
+                continue
+
+            if zone.enabled is False or zone.mode in (0, 3):
+                continue
+
+            # no calculation while the window is open, the valves stay at the pause temperature
+            if self.check_window(zone, now) or zone.Internals["opened_window"] == 1:
+                continue
+
+            if zone.next_calc <= now:  # we start a new calculation
+                due.append(zone)
+
+        if len(due) > 0:
+            self.calculate(due, now)
+
+        self.flush_writes(now)
+
+
+    def over_budget(self):
+        # the running heartbeat spent HEARTBEAT_BUDGET, its remaining work moves to the next heartbeat;
+        # every step checking it has done one unit of work before, so a slow heartbeat still makes progress
+
+        if self.budget_end is None or time.perf_counter() < self.budget_end:
+            return False
+        if not self.carried_over:
+            self.carried_over = True
+            self.count('heartbeat.over_budget')
+        return True
+
+
+    def api_available(self, now):
+        # False while the circuit breaker holds the API calls back, its opening and closing are logged once
+
+        retry_at = self.api.breaker.retry_at
+        if retry_at is None:
+            if self.api_suspended:
+                self.api_suspended = False
+                logger.log("Domoticz API answers again - calls resumed")
+            return True
+
+        if not self.api_suspended:
+            self.api_suspended = True
+            self.count('api.suspended')
+            logger.error("Domoticz API not answering - calls suspended, next try at {}", retry_at)
+        return False
+
+
+    def schedule(self, now):
+        # next deadline with heartbeat work and a Domoticz heartbeat interval matching it
+
+        deadlines = [zone.save_due for zone in self.zones if zone.save_due is not None]
+
+        if self.enabled:
+            for zone in self.zones:
+                if zone.enabled and zone.mode not in (0, 3):
+                    deadlines.append(zone.next_calc)
+                    if zone.window_due is not None:
+                        deadlines.append(zone.window_due)
+
+        if self.metrics_due is not None:
+            deadlines.append(self.metrics_due)
+
+        if len(self.events) > 0:
+            deadlines.append(self.events[0][0])
+
+        deadlines.extend(due for priority, due, params in self.pending.values())
+
+        if self.api is not None and self.api.breaker.retry_at is not None:
+            deadlines.append(self.api.breaker.retry_at)
+
+        self.next_deadline = min(deadlines) if deadlines else now + timedelta(seconds=HEARTBEAT_MAX)
+
+        if self.carried_over or (self.worker is not None and self.worker.pending() > 0):
+            # work left by the heartbeat budget or queued I/O - picked up by the next heartbeat
+            self.set_heartbeat(HEARTBEAT_MIN)
+        elif self.next_deadline <= now:
+            # overdue work waiting for something (e.g. sensor readings) - retry at the Domoticz default pace
+            self.set_heartbeat(HEARTBEAT_RETRY)
+        else:
+            self.set_heartbeat(math.ceil((self.next_deadline - now).total_seconds()))
+
+
+    def set_heartbeat(self, seconds):
+
+        seconds = min(HEARTBEAT_MAX, max(HEARTBEAT_MIN, seconds))
+        if seconds != self.heartbeat_interval:
+            self.heartbeat_interval = seconds
+            domoticz.Heartbeat(seconds)
+
+
+    def wake(self):
+        # the next heartbeat evaluates every zone
+
+        self.next_deadline = None
+        self.set_heartbeat(HEARTBEAT_MIN)
+
+
+    def check_window(self, zone, now):
+        # True when an opened / closed window was handled for the zone in this heartbeat
+
+        if len(zone.open_window_sensors) > 0:
+            # window sensors not notifying SVTP are polled, a delta read returns only what changed
+            poll = timedelta(seconds=WINDOW_POLL)
+            if any(self.cache.get(idx, poll, now) is None for idx in zone.open_window_sensors):
+                self.refresh_devices()
+            zone.window_due = now + poll
+        else:
+            zone.window_due = None
+
+        opened_window, opened_window_time = self.get_window_data(zone)
+
+        if opened_window == zone.Internals["opened_window"]:
+            return False
+
+        if opened_window_time is None:
+            # an open window saved before a restart and nothing known since - assumed closed from now on
+            zone.drop_changed = opened_window_time = now
+
+        due = opened_window_time + timedelta(minutes=self.pause_on_delay if opened_window else self.pause_off_delay)
+        if due > now:
+            # the scheduler wakes the heartbeat when the delay ends
+            if zone.window_due is None or due < zone.window_due:
+                zone.window_due = due
+            return False
+
+        zone.Internals["opened_window"] = opened_window
+
+        if opened_window == 1:
+            logger.log("Opened window in zone {} - set pause temp {}", zone.unit, zone.pause_temp)
+            self.count('window.opened')
+            self.set_target_temp(zone, zone.pause_temp, 0.0, force=True)
+            zone.next_calc = now + timedelta(minutes=self.calculate_period / 2)
+        else:
+            logger.log("Closed window in zone {} - set {} {}", zone.unit, zone.Internals["target_temp"], zone.Internals["current_delta"])
+            self.count('window.closed')
+            self.set_target_temp(zone, zone.Internals["target_temp"], zone.Internals["current_delta"], force=True)
+            zone.next_calc = now + timedelta(minutes=self.calculate_period)
+
+        zone.last_calc = now
+        self.save_internals(zone)
+        return True
+
+
+    def calculate(self, due, now):
+        # one batched PID / delta update for every zone due in this heartbeat
+
+        # sensors are read from memory, polled when not read or notified within half a calculation period -
+        # every calculation works on a reading of its own period; the sensor timeout only leaves out
+        # sensors not updated (LastUpdate) for that long
+        poll = timedelta(minutes=self.calculate_period) / 2
+
+        zones = []
+        current = array('d')
+        for zone in due:
+
+            # zones not reached keep their next_calc and are calculated by the next heartbeat
+            if len(zones) > 0 and self.over_budget():
+                break
+
+            if any(self.cache.get(idx, poll, now) is None for idx in zone.in_temp_sensors):
+                # readings are fetched by the I/O worker and used by the next heartbeat
+                self.refresh_devices()
+
+                # one heartbeat of waiting, after a failed read the cached readings are used
+                if not zone.waited:
+                    zone.waited = True
+                    continue
+
+            zone.waited = False
+
+            current_temp, newest = self.get_current_temp(zone, now)
+
+            if current_temp is None:
+                logger.limited(logger.ERROR, ('no_temp', zone.unit), "Skipping calc - no temperature sensor reading")
+                self.count('calc.skip_no_temp')
+                zone.last_calc = now
+                zone.next_calc = self.align_to_wake(zone, now + timedelta(minutes=self.calculate_period))
+                continue
+
+            # the integral would add the error of a reading it has already added
+            reading = (newest, zone.Internals["target_temp"])
+            if reading == zone.used_reading:
+                logger.debug("Skipping calc - no new temperature reading since the last calculation")
+                self.count('calc.skip_old_reading')
+                zone.last_calc = now
+                zone.next_calc = self.align_to_wake(zone, now + timedelta(minutes=self.calculate_period))
+                continue
+            zone.used_reading = reading
+
+            zone.current_temp = current_temp
+            if zone.heatup is not None:
+                self.learn_heatup(zone, current_temp, now)
+
+            zones.append(zone)
+            current.append(current_temp)
+
+        if len(zones) == 0:
+            return
+
+        # valves still learning their wake up need LastUpdate more often than the sensors are polled,
+        # mains powered valves never report on their own - they give up after WAKE_POLLS reads
+        learning = [self.wakes[idx] for zone in zones for idx in zone.radiators
+                    if self.wakes[idx].polls < WAKE_POLLS and self.wakes[idx].predict(now) is None]
+        if len(learning) > 0:
+            for tracker in learning:
+                tracker.polls += 1
+            self.refresh_devices()
+
+        target = array('d', (zone.Internals["target_temp"] for zone in zones))
+        integral = array('d', (zone.Internals["integral"] for zone in zones))
+        previous_error = array('d', (zone.Internals["previous_error"] for zone in zones))
+        current_delta = array('d', (zone.Internals["current_delta"] for zone in zones))
+
+        status, derivative = compute_shifts(self.shift_calc_mode, self.Kp, self.Ki, self.Kd, self.max_shift, self.sensor_prec_temp,
+                                            target, current, integral, previous_error, current_delta)
+
+        if self.telemetry is not None:
+            self.record_telemetry(zones, now, status, target, current, integral, previous_error, current_delta, derivative)
+
+        for i, zone in enumerate(zones):
+
+            zone.last_calc = now
+            zone.next_calc = self.align_to_wake(zone, now + timedelta(minutes=self.calculate_period))
+
+            if status[i] == CALC_SKIP_PREC:
+                logger.debug("Skipping calc - current_temp {}, target_temp {}, prec {}", current[i], target[i], self.sensor_prec_temp)
+                self.count('calc.skip_prec')
+                continue
+
+            if status[i] == CALC_SKIP_MAX_SHIFT:
+                logger.limited(logger.LOG, ('max_shift', zone.unit), "Skipping calc - max_shift reached")
+                self.count('calc.skip_max_shift')
+                continue
+
+            self.count('calc.done')
+
+            zone.Internals["integral"] = integral[i]
+            zone.Internals["previous_error"] = previous_error[i]
+            zone.Internals["current_delta"] = current_delta[i]
+
+            if self.shift_calc_mode == 1:
+                logger.debug("PID current_temp {}, target_temp {}, temp_shift {}, p {}, i {}, d {}", current[i], target[i], current_delta[i], previous_error[i], integral[i], derivative[i])
+            else:
+                logger.debug("SD current_temp {}, temp_shift {}", current[i], current_delta[i])
 
             
             # set valves setpoint 
             # TODO: PID/Delta setpoint/adjustval
             
                 
-            self.set_target_temp(self.Internals["target_temp"], self.Internals["current_delta"], None)
+            self.set_target_temp(zone, zone.Internals["target_temp"], zone.Internals["current_delta"], None)
            
-            # TODO: next calc after TRV wake up
-            self.last_calc = now
-            self.next_calc = now + timedelta(minutes=self.calculate_period)
-            self.save_internals()
+            self.save_internals(zone)
             
             
-            domoticz.Log("Next calculation time will be : " + str(self.next_calc))
+            logger.log("Next calculation time will be : {}", zone.next_calc)
         
 
-    def get_window_data(self):
-    
-        if self.open_window_sensors is None or len(self.open_window_sensors) == 0:
-            return 0, '2000-01-01 12:00:00'
-            
-        for i_window_dev in self.open_window_sensors:
-            pass
-            
-        return 0, '2000-01-01 12:00:00'
-        
-    def get_temp_data(self, idx):
-        
-        v_json = self.get_device_status(idx)
-        device = v_json['result'][0]
-        
-        domoticz.Debug(str(device))
-        
-        if device['Type'] != 'Temp' or device['SubType'] != 'LaCrosse TX3':
-            domoticz.Error("Device {} is not a thermometer".format(idx))
-            return None
-            
-        else:
-            return float(device['Temp']), device['LastUpdate']
+    def load_schedule(self, path, now):
+        # weekly rules of the schedule file into the event heap, no file - no schedule
+
+        try:
+            with open(path) as f:
+                rules = parse_schedule(f.read(), self.zones_by_unit)
+        except FileNotFoundError:
+            return
+        except OSError as e:
+            logger.error("Cannot read the schedule {}: {}", path, e)
+            return
+
+        for line, error in rules[1]:
+            logger.error("Schedule {} line {}: {}", path, line, error)
+
+        for kind, units, weekday, minute, value in rules[0]:
+            at = next_weekly(now, weekday, minute)
+            if kind == 'exercise':
+                self.push_event(at, 'exercise', value, at)
+            else:
+                for unit in units:
+                    self.push_mode_event(self.zones_by_unit[unit], value, at, now)
+
+        logger.log("Schedule {}: {} rules, next event {}", path, len(rules[0]), self.events[0][0] if self.events else None)
+
+
+    def push_event(self, due, kind, *args):
+        heapq.heappush(self.events, (due, next(self.event_seq), kind, args))
+
+
+    def push_mode_event(self, zone, nvalue, at, now):
+        # switches to Normal are looked at PREHEAT_MAX minutes early, the learned heat-up decides when they start
+
+        if nvalue == 1:
+            self.push_event(max(now, at - timedelta(minutes=PREHEAT_MAX)), 'preheat', zone, nvalue, at)
+        else:
+            self.push_event(at, 'mode', zone, nvalue, at)
+
+
+    def run_events(self, now):
+
+        while len(self.events) > 0 and self.events[0][0] <= now:
+            due, seq, kind, args = heapq.heappop(self.events)
+
+            if kind == 'preheat':
+                zone, nvalue, at = args
+                self.push_event(max(now, at - self.heatup_lead(zone)), 'mode', zone, nvalue, at)
+
+            elif kind == 'mode':
+                zone, nvalue, at = args
+                self.push_mode_event(zone, nvalue, at + timedelta(days=7), now)
+                if zone.enabled and zone.mode != nvalue:
+                    logger.log("Schedule: zone {} mode {} due {} ({:.0f} minutes early)", zone.unit, nvalue, at, max(0.0, (at - now).total_seconds() / 60.0))
+                    self.switch_mode(zone, nvalue, now)
+
+            elif kind == 'exercise':
+                minutes, at = args
+                self.push_event(at + timedelta(days=7), 'exercise', minutes, at + timedelta(days=7))
+                # one valve after the other, the radio network and the boiler see a single closed valve at a time
+                valves = [(zone, idx) for zone in self.zones if zone.enabled and zone.mode != 0 for idx in zone.radiators]
+                for n, (zone, idx) in enumerate(valves):
+                    self.push_event(now + timedelta(seconds=n * EXERCISE_STAGGER), 'close', zone, idx, minutes)
+
+            elif kind == 'close':
+                zone, idx, minutes = args
+                logger.log("Valve exercise: closing {} for {} minutes", idx, minutes)
+                params = self.valve_params(zone, idx, target_temp=EXERCISE_TEMP, shift_temp=0.0)
+                self.exercising.add(idx)
+                self.remember_setpoint(params, now)
+                self.queue_write(params, now, force=True)
+                self.push_event(now + timedelta(minutes=minutes), 'open', zone, idx)
+
+            elif kind == 'open':
+                zone, idx = args
+                self.exercising.discard(idx)
+                self.restore_valves(zone)
+
+
+    def restore_valves(self, zone):
+        # set point the zone asks for now, valves holding it are not written
+
+        if zone.mode == 0:
+            return
+        if zone.Internals["opened_window"] == 1 or zone.mode == 3:
+            self.set_target_temp(zone, zone.pause_temp, 0.0, force=True)
+        else:
+            self.set_target_temp(zone, zone.Internals["target_temp"], zone.Internals["current_delta"], force=True)
+
+
+    def switch_mode(self, zone, nvalue, now):
+        # scheduled mode change: valves already holding the new set point are not written, the state save is coalesced
+
+        zone.Internals["nValue"] = nvalue
+        zone.Internals["target_temp"] = {1: zone.high_temp, 2: zone.low_temp, 3: zone.pause_temp}.get(nvalue, -100.0)
+        zone.mode = nvalue
+        zone.reset_cnt = 0
+        zone.reload_cnt = 0
+
+        # an open window keeps the pause temperature, closing it restores the new target
+        if nvalue != 0 and zone.Internals["opened_window"] == 0:
+            self.restore_valves(zone)
+
+        if nvalue == 1:
+            self.start_heatup(zone, now)
+
+        self.save_internals(zone)
+        Devices[zone.unit].Update(nValue=nvalue, sValue=str(10 * nvalue))
+
+
+    def start_heatup(self, zone, now):
+        # a switch to Normal from a room clearly below the high temperature is timed for the heat-up rate
+
+        if zone.current_temp is not None and zone.current_temp < zone.high_temp - HEATUP_MIN_RISE:
+            zone.heatup = (now, zone.current_temp)
+        else:
+            zone.heatup = None
+
+
+    def learn_heatup(self, zone, current_temp, now):
+
+        started, start_temp = zone.heatup
+        minutes = (now - started).total_seconds() / 60.0
+
+        if zone.mode != 1 or zone.Internals["opened_window"] == 1 or minutes > 60 * HEATUP_MAX_HOURS:
+            zone.heatup = None
+            return
+
+        if current_temp < zone.Internals["target_temp"] - 2.0 * self.sensor_prec_temp or minutes < 10:
+            return
+
+        zone.heatup = None
+        rate = 60.0 * (current_temp - start_temp) / minutes
+        if rate <= 0:
+            return
+
+        # smoothed over heat-ups, one cold morning does not move it much
+        old = zone.Internals["heat_rate"]
+        zone.Internals["heat_rate"] = round(rate if old <= 0 else old + HEATUP_WEIGHT * (rate - old), 2)
+        logger.log("Zone {} heated {:.1f} C in {:.0f} minutes - heat-up rate {} C/h", zone.unit, current_temp - start_temp, minutes, zone.Internals["heat_rate"])
+        self.save_internals(zone)
+
+
+    def heatup_lead(self, zone):
+        # how long before a scheduled Normal the heating starts, 0 while the rate or the room temperature is unknown
+
+        rate = zone.Internals["heat_rate"]
+        if rate <= 0 or zone.current_temp is None or zone.mode == 1:
+            return timedelta(0)
+
+        rise = zone.high_temp - zone.current_temp
+        return timedelta(minutes=min(PREHEAT_MAX, max(0.0, 60.0 * rise / rate)))
+
+
+    def record_telemetry(self, zones, now, status, target, current, integral, previous_error, current_delta, derivative):
+        # one record per zone and calculation, skipped calculations included with their status
+
+        timestamp = now.timestamp()
+        try:
+            for i, zone in enumerate(zones):
+                self.telemetry.record(timestamp, zone.unit, status[i], current[i], target[i], current_delta[i],
+                                      previous_error[i], integral[i], self.Kp * previous_error[i],
+                                      self.Ki * integral[i], self.Kd * derivative[i], target[i] + current_delta[i])
+        except (OSError, ValueError, struct.error) as e:
+            logger.error("Telemetry recording stopped: {}", e)
+            self.telemetry.close()
+            self.telemetry = None
+
+
+    def get_window_data(self, zone):
+        # (opened, time of the change) from the window sensors of the zone and the temperature drop detection,
+        # open since the first window opened, closed since the last one closed - None while nothing is known
+
+        opened, changed = 0, None
+
+        for idx in zone.open_window_sensors:
+            state = self.windows.get(idx)
+            if state is None:
+                continue
+
+            if state[0]:
+                if opened == 0 or state[1] < changed:
+                    opened, changed = 1, state[1]
+            elif opened == 0 and (changed is None or state[1] > changed):
+                changed = state[1]
+
+        if zone.drop_changed is not None and opened == 0:
+            if zone.drop:
+                return 1, zone.drop_changed
+            if changed is None or zone.drop_changed > changed:
+                changed = zone.drop_changed
+
+        return opened, changed
+
+    def record_sensors(self):
+        # new readings of the cached temperature sensors into their history and window state changes,
+        # one pass over the cache after each read or notification
+
+        for idx, history in self.history.items():
+            device = self.cache.devices.get(idx)
+            if device is None or device.get('LastUpdate') == history.last_raw:
+                continue
+
+            # any Temp* type (Temp, Temp + Humidity, ...) - a valve or switch listed in Mode1 is not used
+            if not str(device.get('Type', '')).startswith('Temp') or 'Temp' not in device:
+                logger.limited(logger.ERROR, ('thermometer', idx), "Device {} is not a thermometer", idx)
+                continue
+
+            history.last_raw = device['LastUpdate']
+            if history.add(float(device['Temp']), ParseDateTime(device['LastUpdate']).timestamp()):
+                for zone in self.sensor_zones[idx]:
+                    self.check_drop(zone, history.last_time())
+
+        for idx in self.window_sensors:
+            device = self.cache.devices.get(idx)
+            if device is None or 'Status' not in device:
+                continue
+
+            opened = device['Status'] in ('Open', 'On')
+            state = self.windows.get(idx)
+            if state is None or state[0] != opened:
+                self.windows[idx] = (opened, ParseDateTime(device['LastUpdate']))
+                if state is not None:
+                    logger.debug("Window sensor {} {}", idx, device['Status'])
+
+
+    def check_drop(self, zone, timestamp):
+        # an open window inferred from the room temperature falling fast and far enough,
+        # ended when the fall flattens or after DROP_PAUSE_MAX minutes
+
+        when = datetime.fromtimestamp(timestamp)
+
+        # the valves at the pause temperature keep the room cooling - a paused zone and a zone still
+        # recovering from an inferred window do not count as a new drop
+        if not zone.drop and (zone.Internals["opened_window"] == 1 or
+                              (zone.drop_holdoff is not None and when < zone.drop_holdoff)):
+            return
+
+        slopes = [slope for slope in (self.history[idx].slope() for idx in zone.in_temp_sensors) if slope is not None]
+        if len(slopes) == 0:
+            return
+
+        if not zone.drop:
+            if any(rate <= -DROP_RATE and -rate * span / 60.0 >= DROP_DELTA for rate, span in slopes):
+                logger.log("Temperature drop in zone {} - window assumed open", zone.unit)
+                self.count('window.drop')
+                zone.drop, zone.drop_changed = True, when
+
+        elif all(rate > -DROP_RATE / 4.0 for rate, span in slopes):
+            logger.log("Temperature drop in zone {} ended - window assumed closed", zone.unit)
+            zone.drop, zone.drop_changed = False, when
+            zone.drop_holdoff = when + timedelta(minutes=self.pause_off_delay + DROP_HOLDOFF)
+
+        elif when - zone.drop_changed >= timedelta(minutes=DROP_PAUSE_MAX):
+            # still falling - most likely the pause itself, the zone resumes without the pause off delay
+            logger.log("Temperature drop in zone {} lasted {} minutes - window assumed closed", zone.unit, DROP_PAUSE_MAX)
+            zone.drop, zone.drop_changed = False, when - timedelta(minutes=self.pause_off_delay)
+            zone.drop_holdoff = when + timedelta(minutes=DROP_HOLDOFF)
 
             
-    def get_current_temp(self):
-        
-        l_temp = []
-        for i_temp_dev in self.in_temp_sensors:
-            i_temp = self.get_temp_data(i_temp_dev)
-            l_temp.append(i_temp[0])
+    def get_current_temp(self, zone, now):
+        # (aggregate of the sensors updated within the sensor timeout (by their LastUpdate), the TRV temperature
+        # when none is; epoch time of the newest reading used), (None, None) without any reading
+
+        timeout = 60.0 * self.temp_sensors_timeout
+        now_ts = now.timestamp()
+
+        readings = []
+        for i_temp_dev in zone.in_temp_sensors:
+            history = self.history.get(i_temp_dev)
+            if history is None or history.count == 0:
+                continue
+
+            age = now_ts - history.last_time()
+            if age > timeout:
+                logger.limited(logger.LOG, ('stale', i_temp_dev), "Thermometer {} not updated for {:.0f} minutes - ignored", i_temp_dev, age / 60.0)
+                continue
+            readings.append((history.last(), age))
+            logger.debug("Thermometer {} temp {} age {:.0f} s window mean {:.2f}", i_temp_dev, history.last(), age, history.mean())
+
+        if len(readings) == 0:
+            readings = self.get_valve_temps(zone, now_ts, timeout)
+            if len(readings) == 0:
+                return None, None
+            logger.limited(logger.LOG, ('trv_temp', zone.unit), "No thermometer updated in zone {} - using the TRV temperature", zone.unit)
           
-        mean_temp = round(1.0 * sum(l_temp) / len(l_temp), 1)
-        return mean_temp
+        return round(aggregate_temps(self.sensors_mode, readings, timeout), 1), \
+            round(now_ts - min(age for value, age in readings), 3)
+
+
+    def get_valve_temps(self, zone, now_ts, timeout):
+        # the internal temperature some TRVs report with their set point
+
+        readings = []
+        for i_trv_dev in zone.radiators:
+            device = self.cache.devices.get(i_trv_dev)
+            if device is None or 'Temp' not in device:
+                continue
+
+            age = now_ts - ParseDateTime(device['LastUpdate']).timestamp()
+            if age <= timeout:
+                readings.append((float(device['Temp']), age))
+
+        return readings
         
     
 
             
     def get_valve_data(self, idx):
     
-        v_json = self.get_device_status(idx)
-        device = v_json['result'][0]
+        device = self.get_device_status(idx)
+        if device is None:
+            logger.limited(logger.ERROR, ('no_valve', idx), "Cannot read thermostat {}", idx)
+            return None
         
-        domoticz.Debug(str(device))
+        logger.debug("{}", device)
         
         if device['Type'] != 'Thermostat' or device['SubType'] != 'SetPoint':
-            domoticz.Error("Device {} is not a thermostat".format(idx))
+            logger.error("Device {} is not a thermostat", idx)
             return None
             
         else:
             return float(device['SetPoint']), float(device['AddjValue']), device['LastUpdate']
 
             
-    def set_valve_temp(self, idx, target_temp, shift_temp):
+    def valve_params(self, zone, idx, target_temp, shift_temp):
     
-        domoticz.Debug("set_valve_temp idx {} temp {} shift {} trv control {}".format(idx, target_temp, shift_temp, self.trv_control))
+        logger.debug("valve_params idx {} temp {} shift {} trv control {}", idx, target_temp, shift_temp, self.trv_control)
         
-        url = 'http://localhost:8080/json.htm?type=command&param=setsetpoint&idx={}'.format(idx)
+        params = {'type': 'command', 'param': 'setsetpoint', 'idx': idx}
         
         if self.max_shift is not None or self.max_shift > 0:
             if abs(shift_temp) > self.max_shift:
@@ -478,153 +2164,702 @@ class BasePlugin:
                 
         
         if target_temp is None and shift_temp is None:
-            domoticz.Error("set_valve_temp for {} - temp and shift is None".format(idx))
-            url += '&setpoint={}'.format(self.Internals["target_temp"])
+            logger.error("valve_params for {} - temp and shift is None", idx)
+            params['setpoint'] = zone.Internals["target_temp"]
             
         elif self.trv_control == 1: # setpoint
 
-            url += '&setpoint={}'.format(target_temp + shift_temp)
+            params['setpoint'] = target_temp + shift_temp
             
         elif self.trv_control == 2: # shift
 
-            url += '&setpoint={}'.format(target_temp)
-            url += '&addjvalue={}'.format(round(-1.0*shift_temp,1))
+            params['setpoint'] = target_temp
+            params['addjvalue'] = round(-1.0*shift_temp,1)
             
         elif self.trv_control == 3: # external sensor
-            domoticz.Error("external_sensor is not implemented")
-            url += '&setpoint={}'.format(self.Internals["target_temp"])
+            logger.error("external_sensor is not implemented")
+            params['setpoint'] = zone.Internals["target_temp"]
             
         else:
-            domoticz.Error("Unknown control method")
-            url += '&setpoint={}'.format(self.Internals["target_temp"])
+            logger.error("Unknown control method")
+            params['setpoint'] = zone.Internals["target_temp"]
 
    
-        domoticz.Debug(url)
-        
-        response = requests.post(url)
-        if response.status_code != 200:
-            domoticz.Error("set_valve_temp temp {} for {} reponded {}".format(temp, idx, response.status_code))
+        logger.debug("{}", params)
+
+        return params
             
        
         
-    def set_target_temp(self, temp, shift, force=False):
+    def set_target_temp(self, zone, temp, shift, force=False):
         
-        max_next_update_time = None
+        next_wake = None
+        now = datetime.now()
         
-        for i_trv_dev in self.radiators:
-            v_data = self.get_valve_data(i_trv_dev)
+        for i_trv_dev in zone.radiators:
+            if i_trv_dev in self.exercising:
+                continue
+            params = self.valve_params(zone, i_trv_dev, target_temp=temp, shift_temp=shift)
+
+            # the last commanded value saves reading the valve back
+            commanded = self.get_commanded(i_trv_dev, now)
+            if commanded is not None:
+                c_stp, c_shift = commanded[0], commanded[1]
+            else:
+                # forced writes (mode changes, windows) do not wait for a device reading
+                v_data = self.get_valve_data(i_trv_dev) if i_trv_dev in self.cache.devices else None
+                if v_data is None and force is False:
+                    continue
+                c_stp, c_shift = v_data[:2] if v_data is not None else (None, None)
+
+            if c_stp is None:
+                changed = True
+            elif force is True:
+                # a forced write is still redundant when the valve already has the value
+                changed = abs(params['setpoint'] - c_stp) >= 0.05 or \
+                          ('addjvalue' in params and (c_shift is None or abs(params['addjvalue'] - c_shift) >= 0.05))
+            else:
+                changed = abs(temp + shift - c_stp) >= self.trv_prec_temp # or abs(shift - v_data[1]) > self.prec_temp:
             
-            if force is True or abs(temp + shift - v_data[0]) >= self.trv_prec_temp: # or abs(shift - v_data[1]) > self.prec_temp:
-                domoticz.Log("set_target_temp - idx {} c_stp {} c_shift {} targ {} shift {} prec {} trv_mode {}".format(i_trv_dev, v_data[0], v_data[1], temp, shift, self.trv_prec_temp, self.trv_control))
-                self.set_valve_temp(i_trv_dev, target_temp=temp, shift_temp=shift)
-                max_next_update_time = v_data[2]
+            if changed:
+                logger.log("set_target_temp - idx {} c_stp {} c_shift {} targ {} shift {} prec {} trv_mode {}", i_trv_dev, c_stp, c_shift, temp, shift, self.trv_prec_temp, self.trv_control)
+                self.remember_setpoint(params, now)
+                due = self.queue_write(params, now, force)
+                if next_wake is None or due > next_wake:
+                    next_wake = due
             
             else:
-                domoticz.Debug("Skipping set_target_temp - idx {} c_temp {} n_temp {} c_shift {} n_shift {} prec {}".format(i_trv_dev, v_data[0], temp, v_data[1], shift, self.trv_prec_temp))
+                logger.limited(logger.DEBUG, ('skip_set', i_trv_dev), "Skipping set_target_temp - idx {} c_temp {} n_temp {} c_shift {} n_shift {} prec {}", i_trv_dev, c_stp, temp, c_shift, shift, self.trv_prec_temp)
           
         
-        return max_next_update_time 
-        # TODO: return last next TRV wake up
+        # latest time a write of this call goes out
+        return next_wake
 
-        # pause
-        
-        # check set temp
-        # for i_trv_dev in self.radiators:
-        #    v_data = self.get_valve_data(i_trv_dev)
-        #    if abs(temp - v_data[0]) > self.prec_temp:
-        #        domoticz.Error("TRV temp setting error: idx {}, setpoint {}, target {}, prec {}".format(i_trv_dev, v_data[0], temp, self.prec_temp))
 
+    def count(self, name, n=1):
 
-    def get_device_status(self, idx):
-        # /json.htm?type=devices&rid=IDX
-        
-        url = 'http://localhost:8080/json.htm?type=devices&rid={}'.format(idx)
-        response = requests.get(url)
-        
-        if response.status_code == 200:
-            return response.json()
-        else:
+        if self.metrics is not None:
+            self.metrics.incr(name, n)
+
+
+    def report_metrics(self):
+        # one summary log line per metrics_interval, devices updated with the values of the period
+
+        now = datetime.now()
+        self.metrics_due = now + timedelta(minutes=self.metrics_interval)
+        period, counters, histograms = self.metrics.collect(now)
+
+        api = sorted(name for name in histograms if name.startswith("api."))
+        api_errors = sum(n for name, n in counters.items() if name.endswith(".errors"))
+        valve_writes_h = 60.0 * counters.get('valve_writes', 0) / period if period > 0 else 0.0
+
+        logger.log("Metrics {:.0f} min: heartbeat {}, over budget {}; {}; API errors {}, retries {}, rejected {}; "
+                     "calc done {}, skip prec {}, skip max_shift {}, "
+                     "skip no temp {}, skip old reading {}; valve writes {:.1f}/h, deferred {}, coalesced {}, queue {}",
+                         period, histograms['heartbeat'].summary() if 'heartbeat' in histograms else "n 0",
+                         counters.get('heartbeat.over_budget', 0),
+                         "; ".join("{} {}".format(name[4:], histograms[name].summary()) for name in api) or "API idle",
+                         api_errors, counters.get('api.retries', 0), counters.get('api.rejected', 0),
+                         counters.get('calc.done', 0), counters.get('calc.skip_prec', 0),
+                         counters.get('calc.skip_max_shift', 0), counters.get('calc.skip_no_temp', 0),
+                         counters.get('calc.skip_old_reading', 0), valve_writes_h, counters.get('writes.deferred', 0),
+                         counters.get('writes.coalesced', 0), len(self.pending))
+
+        if self.metrics_mode != 2:
+            return
+
+        api_count = sum(histograms[name].count for name in api)
+        values = {
+            METRICS_UNITS['heartbeat']: histograms['heartbeat'].total / histograms['heartbeat'].count if 'heartbeat' in histograms else 0.0,
+            METRICS_UNITS['api_latency']: sum(histograms[name].total for name in api) / api_count if api_count else 0.0,
+            METRICS_UNITS['valve_writes']: valve_writes_h,
+            METRICS_UNITS['calc_done']: counters.get('calc.done', 0),
+            METRICS_UNITS['calc_skipped']: sum(n for name, n in counters.items() if name.startswith("calc.") and name != 'calc.done'),
+        }
+        for unit, value in values.items():
+            if unit in Devices:
+                Devices[unit].Update(nValue=0, sValue="{:.2f}".format(value))
+
+        if METRICS_UNITS['api_errors'] in Devices:
+            Devices[METRICS_UNITS['api_errors']].Update(nValue=0, sValue=str(api_errors))
+
+
+    def create_metrics_devices(self):
+
+        for key, (name, typename, options) in METRICS_DEVICES.items():
+            unit = METRICS_UNITS[key]
+            if unit not in Devices:
+                domoticz.Device(Name=name, Unit=unit, TypeName=typename, Options=options, Used=1).Create()
+
+
+    def queue_write(self, params, now, force=False):
+        # one pending write per valve, a newer value replaces the waiting one
+        # PID adjustments wait for the valve wake up, forced writes (mode changes, windows) are urgent
+        # returns the time the write is due
+
+        idx = int(params['idx'])
+        priority = PRIORITY_URGENT if force else PRIORITY_NORMAL
+        due = now if force else self.write_due(idx, now)
+
+        waiting = self.pending.get(idx)
+        if waiting is not None:
+            self.count('writes.coalesced')
+            if waiting[0] > priority:
+                # an urgent write keeps its place, only the value is replaced
+                priority, due = waiting[0], min(due, waiting[1])
+
+        self.pending[idx] = (priority, due, params)
+        if due > now:
+            logger.debug("Valve {} write deferred to the wake up at {}", idx, due)
+
+        return due
+
+
+    def write_due(self, idx, now):
+        # just before the predicted wake up, now when unknown or already within the lead time
+
+        tracker = self.wakes.get(idx)
+        wake = tracker.predict(now) if tracker is not None else None
+        if wake is None:
+            return now
+
+        due = wake - timedelta(seconds=WAKE_LEAD)
+        return due if due > now else now
+
+
+    def align_to_wake(self, zone, earliest):
+        # next calculation just before the first valve wake up after earliest, if that is within one period
+
+        wakes = [wake for wake in (self.wakes[idx].predict(earliest + timedelta(seconds=WAKE_LEAD))
+                                   for idx in zone.radiators if idx in self.wakes) if wake is not None]
+        if len(wakes) == 0:
+            return earliest
+
+        aligned = min(wakes) - timedelta(seconds=WAKE_LEAD)
+        if aligned - earliest > timedelta(minutes=self.calculate_period):
+            return earliest
+        return aligned
+
+
+    def learn_wakes(self):
+
+        for idx, tracker in self.wakes.items():
+            device = self.cache.devices.get(idx)
+            if device is not None and 'LastUpdate' in device:
+                tracker.observe(device['LastUpdate'])
+
+
+    def flush_writes(self, now=None):
+        # sends the due writes within the network budget, urgent ones first
+        # PID adjustments of one valve are at least valve_min_interval apart
+
+        now = now or datetime.now()
+        ready = sorted((-priority, due, idx) for idx, (priority, due, params) in self.pending.items() if due <= now)
+        if len(ready) == 0:
+            return
+
+        # Domoticz is not answering - the writes stay queued, the newest value per valve is sent after the breaker closes
+        if self.api.breaker.retry_at is not None:
+            return
+
+        batch = []
+        for priority, due, idx in ready:
+
+            if len(batch) > 0 and self.over_budget():
+                break
+
+            last_write = self.last_write.get(idx)
+            if -priority < PRIORITY_URGENT and last_write is not None and \
+                    (now - last_write).total_seconds() < self.valve_min_interval:
+                self.hold_write(idx, last_write + timedelta(seconds=self.valve_min_interval))
+                continue
 
+            if not self.write_bucket.take(now):
+                self.hold_write(idx, self.write_bucket.next_token(now))
+                continue
+
+            batch.append(self.pending.pop(idx)[2])
+            self.held.discard(idx)
+            self.last_write[idx] = now
+            if idx in self.wakes:
+                self.wakes[idx].sent = now
+            self.cache.invalidate(idx)
+
+        if len(batch) == 0:
+            return
+
+        self.count('valve_writes', len(batch))
+
+        # one job: all valves written concurrently, then a single read back to check set temp
+        self.dispatch('setpoints', write_setpoints, batch, min(len(batch), self.write_pool_size), self.shared,
+                      self.wanted)
+
+
+    def hold_write(self, idx, due):
+        # a write over the rate limits waits until it may go, the scheduler wakes up for it
+
+        priority, waiting, params = self.pending[idx]
+        self.pending[idx] = (priority, due, params)
+
+        if idx not in self.held:
+            self.held.add(idx)
+            self.count('writes.deferred')
+            logger.limited(logger.DEBUG, ('held', idx), "Valve {} write held back until {} - rate limit", idx, due)
+
+
+    def remember_setpoint(self, params, now):
+        # write-through: the value is cached when the write is queued and dropped if the write fails
+
+        self.commanded[int(params['idx'])] = (float(params['setpoint']), params.get('addjvalue'), now)
+
+
+    def get_commanded(self, idx, now):
+
+        commanded = self.commanded.get(idx)
+        if commanded is None:
             return None
-       
-        #postdata = {'type':'command', 'param':'udevice', 'idx':'358', 'svalue':'66'}
-        # resp = requests.get(url=url, params=postdata)
 
-        
-    def save_internals(self, add=False):
+        if now - commanded[2] > timedelta(minutes=self.setpoint_cache_ttl):
+            del self.commanded[idx]
+            return None
+
+        # a newer LastUpdate with another setpoint means the valve was changed outside of SVTP
+        # (a write waiting for the wake up is not on the valve yet)
+        device = self.cache.get(idx)
+        if device is not None and idx not in self.pending and ParseDateTime(device['LastUpdate']) > commanded[2] and \
+                abs(float(device['SetPoint']) - commanded[0]) >= 0.05:
+            logger.log("Valve {} setpoint changed outside SVTP: {} -> {}", idx, commanded[0], device['SetPoint'])
+            del self.commanded[idx]
+            return None
+
+        return commanded
+
+
+    def check_setpoints(self, batch, results, devices):
+        # per-valve report of a write_setpoints job
+
+        for params, (result, error) in zip(batch, results):
+            if error is not None:
+                logger.error("Valve setpoint {} for {} failed: {}", params.get('setpoint'), params['idx'], error)
+                self.commanded.pop(int(params['idx']), None)
+
+        if devices is None:
+            logger.error("Cannot check set temp - valves read back failed")
+            return
+
+        setpoints = {int(device['idx']): device.get('SetPoint') for device in devices}
+        for params, (result, error) in zip(batch, results):
+            if error is not None:
+                continue
+
+            setpoint = setpoints.get(int(params['idx']))
+            if setpoint is None or abs(float(params['setpoint']) - float(setpoint)) > self.trv_prec_temp:
+                logger.limited(logger.ERROR, ('trv_error', params['idx']), "TRV temp setting error: idx {}, setpoint {}, target {}, prec {}", params['idx'], setpoint, params['setpoint'], self.trv_prec_temp)
+                self.commanded.pop(int(params['idx']), None)
+
+
+    def get_device_status(self, idx, max_age=None):
+        # served from the device cache, None until a reading has arrived
+
+        return self.cache.get(idx, max_age, datetime.now())
+
+
+    def validate_devices(self):
+        # zones missing a sensor or valve in the first bulk read are turned off
+
+        self.devices_checked = True
+        for zone in self.zones:
+            for i_dev in itertools.chain(zone.in_temp_sensors, zone.radiators):
+                if self.get_device_status(i_dev) is None:
+                    logger.error("Device {} is not present - turning off zone {}", i_dev, zone.unit)
+                    zone.enabled = False
+                    break
+
+
+    def refresh_devices(self):
+        # one /json.htm?type=devices&filter=all for every idx listed in Mode1/Mode2/Mode3, shared by all zones
+        # once every device is cached, lastupdate= only returns the devices changed since the last read
+
+        if self.devices_pending:
+            return
+
+        # the circuit breaker refuses the read, the readings in the cache (and of the other instances) are used
+        # until it closes
+        use_api = not self.api.breaker.holds(datetime.now())
+        if not use_api and self.shared is None:
+            return
+
+        params = {'type': 'devices', 'filter': 'all'}
+        if self.cache.act_time is not None and self.cache.has_all(self.wanted):
+            params['lastupdate'] = self.cache.act_time
+
+        # another instance may have read every device of this one a moment ago - the I/O worker looks first,
+        # the shared cache lock is never taken on the plugin thread
+        self.devices_pending = True
+        self.dispatch('devices', read_devices, params, self.shared, self.wanted, self.cache.received, use_api)
+
+
+    def load_shared(self, result):
+        # readings of the other instances into the cache
+
+        for idx, (device, received) in result['shared'].items():
+            # the reading keeps the time it was read, freshness checks see its real age
+            self.cache.update(idx, device, datetime.fromtimestamp(received))
+
+        if result['complete']:
+            self.count('devices.shared')
+            self.devices_loaded()
+
+
+    def devices_loaded(self):
+        # new device readings in the cache
+
+        if not self.devices_checked:
+            self.validate_devices()
+        self.learn_wakes()
+        self.record_sensors()
+
+
+    def dispatch(self, name, func, *args, zone=None):
+        # queued on the I/O worker once it runs, executed inline during onStart
+
+        if self.worker is not None and self.worker.is_alive():
+            self.worker.submit(name, func, args, zone)
+            return
+
+        try:
+            result, error = func(self.api, *args), None
+        except Exception as e:
+            result, error = None, e
+
+        self.on_completion(name, args, zone, result, error)
+
+
+    def process_completions(self):
+        # completions left over when the heartbeat budget is spent are picked up by the next heartbeat
+
+        if self.worker is None:
+            return
+
+        while True:
+            completion = self.worker.next_completion()
+            if completion is None:
+                return
+            self.on_completion(*completion)
+            if self.over_budget():
+                return
+
+
+    def on_completion(self, name, args, zone, result, error):
+
+        if name == 'devices':
+            self.devices_pending = False
+
+            if error is None and 'shared' in result:
+                self.load_shared(result)
+            elif error is None:
+                self.cache.load(result.get('result', []), self.wanted, datetime.now(),
+                                result.get('ActTime'), 'lastupdate' in args[0])
+                self.devices_loaded()
+            else:
+                logger.limited(logger.ERROR, 'refresh_devices', "Cannot refresh devices: {}", error)
+
+        elif name == 'setpoints':
+            if error is not None:
+                logger.error("set_target_temp batch failed: {}", error)
+            else:
+                if result[1] is not None:
+                    self.cache.load(result[1], self.wanted, datetime.now())
+                    self.learn_wakes()
+                    self.record_sensors()
+                self.check_setpoints(args[0], *result)
+
+        elif name == 'save_internals':
+            if error is not None:
+                logger.error("Cannot save_internals for zone {}: {}", zone.unit, error)
+                zone.saved_internals = None
+
+        elif name == 'user_variable':
+            zone.load_pending = False
+            if error is not None or len(result.get('result', [])) == 0:
+                # remembered idx is gone (variable deleted or recreated) - search the full list once
+                logger.debug("User variable idx {} not found - listing user variables", args[0]['idx'])
+                zone.load_pending = True
+                self.dispatch('user_variables', DomoticzAPI.get, {'type': 'command', 'param': 'getuservariables'}, zone=zone)
+            else:
+                self.apply_user_variables(zone, result)
+
+        elif name == 'user_variables':
+            zone.load_pending = False
+            if error is not None:
+                logger.limited(logger.ERROR, ('user_vars', zone.unit), "Cannot get_user_vars: {}", error)
+            self.apply_user_variables(zone, result)
 
-        varname = Parameters["Name"] + "-InternalVariables"
         
+    def save_internals(self, zone, add=False, force=False):
+        # write-behind: unchanged Internals are not written, changes within save_interval are coalesced
+
         if add:
-            cparam = 'adduservariable'
-        else:
-            cparam = 'updateuservariable'
+            self.write_internals(zone, 'adduservariable')
+            return
+
+        # the stored state is still being read, reconcile_internals writes the local changes
+        if zone.load_pending and (self.state_backend == 1 or zone.loading):
+            return
+
+        if zone.Internals == zone.saved_internals:
+            zone.save_due = None
+            return
+
+        if force or self.save_interval <= 0:
+            self.flush_internals(zone)
+
+        elif zone.save_due is None:
+            zone.save_due = datetime.now() + timedelta(minutes=self.save_interval)
+
+
+    def flush_internals(self, zone):
+
+        zone.save_due = None
+        if zone.Internals != zone.saved_internals:
+            self.write_internals(zone, 'updateuservariable')
+
+
+    def write_internals(self, zone, cparam):
+
+        zone.saved_internals = zone.Internals.copy()
+
+        if self.state_backend == 2:
+            self.dispatch('save_internals', write_state_file, zone.state_store, serialize_internals(zone.Internals), zone=zone)
+            return
+
+        varname = Parameters["Name"] + zone.suffix() + "-InternalVariables"
             
-        url = 'http://localhost:8080/json.htm?type=command&param={}&vname={}&vtype=2&vvalue={}'.format(cparam, varname, str(self.Internals))
+        params = {'type': 'command', 'param': cparam, 'vname': varname, 'vtype': 2, 'vvalue': serialize_internals(zone.Internals)}
          
-        response = requests.post(url)
-        
-        if response.status_code != 200:
-            domoticz.Error("Cannot save_internals")
+        self.dispatch('save_internals', write_user_variable, params, zone.state_cache, zone=zone)
         
             
-    def load_internals(self):
+    def state_path(self, zone, extension):
+        return os.path.join(Parameters["HomeFolder"], "svtp-{}{}.{}".format(Parameters.get("HardwareID", Parameters["Name"]),
+                                                                          zone.suffix(), extension))
+
+
+    def load_internals(self, zone):
+        # local state at once, the user variable is read in the background and reconciled when it arrives
+
+        if zone.state_cache is None:
+            zone.state_cache = FileStateStore(self.state_path(zone, "cache"))
+
+        if self.state_backend == 2:
+            if zone.state_store is None:
+                zone.state_store = FileStateStore(self.state_path(zone, "state"))
+
+            if zone.state_store.exists():
+                self.apply_internals_file(zone, zone.state_store)
+                return
+
+            # one-time migration: the user variable is read and written to the file by apply_user_variables
+            logger.log("No state file {} - migrating the user variable", zone.state_store.path)
+            zone.loading = True
+
+        elif zone.state_cache.exists() and not zone.loading:
+            self.apply_internals_file(zone, zone.state_cache)
 
-        url = 'http://localhost:8080/json.htm?type=command&param=getuservariables'
-        response = requests.get(url)
-        
-        if response.status_code == 200:
-            variables = response.json()
         else:
-            domoticz.Error("Cannot get_user_vars")
-            variables = None
-            
-        # variables = self.get_user_vars()
-        if variables:
-            
-            # there is a valid response from the API but we do not know if our variable exists yet
-            novar = True
-            varname = Parameters["Name"] + "-InternalVariables"
-            valuestring = ""
-            
-            if "result" in variables:
-                for variable in variables["result"]:
-                    if variable["Name"] == varname:
-                        valuestring = variable["Value"]
-                        novar = False
-                        break
-            
+            zone.loading = True
+
+        # the variable idx is remembered in the mode device options, listing every variable is the fallback
+        idx = Devices[zone.unit].Options.get("InternalsIdx") if zone.unit in Devices else None
+
+        zone.load_pending = True
+        if idx:
+            self.dispatch('user_variable', DomoticzAPI.get, {'type': 'command', 'param': 'getuservariable', 'idx': idx}, zone=zone)
+        else:
+            self.dispatch('user_variables', DomoticzAPI.get, {'type': 'command', 'param': 'getuservariables'}, zone=zone)
+
+
+    def apply_internals_file(self, zone, store):
+
+        try:
+            zone.Internals.update(parse_internals(store.load(), self.InternalsDefaults))
+            zone.saved_internals = zone.Internals.copy()
+        except (OSError, ValueError, SyntaxError, TypeError) as e:
+            logger.error("Cannot read the state file {}: {}", store.path, e)
+            zone.Internals = self.InternalsDefaults.copy()
+            zone.loading = store is zone.state_cache
+
+
+    def remember_internals_idx(self, zone, idx):
+
+        if zone.unit not in Devices or Devices[zone.unit].Options.get("InternalsIdx") == str(idx):
+            return
+
+        device = Devices[zone.unit]
+        options = dict(device.Options)
+        options["InternalsIdx"] = str(idx)
+        device.Update(nValue=device.nValue, sValue=device.sValue, Options=options, SuppressTriggers=True)
+
+
+    def apply_user_variables(self, zone, variables):
             
-            if novar:
+        if not variables:
+            if zone.loading:
+                # nothing to control with - retried by the heartbeat
+                return
+            logger.error("Cannot read the uservariable holding the persistent variables - keeping the local state")
+            zone.started_internals = None
+            return
 
-                # actually calling Domoticz API
-                self.Internals = self.InternalsDefaults.copy()  # we re-initialize the internal variables
-                self.save_internals(add=True)                
-                
-                
-            else:
+        # there is a valid response from the API but we do not know if our variable exists yet
+        varname = Parameters["Name"] + zone.suffix() + "-InternalVariables"
+
+        for variable in variables.get("result", []):
+            if variable["Name"] == varname:
+                self.remember_internals_idx(zone, variable["idx"])
                 try:
-                    self.Internals.update(eval(valuestring))
-                except:
-                    self.Internals = self.InternalsDefaults.copy()
+                    values = self.InternalsDefaults.copy()
+                    values.update(parse_internals(variable["Value"], self.InternalsDefaults))
+                except (ValueError, SyntaxError, TypeError) as e:
+                    logger.error("Cannot parse the persistent variables '{}': {}", variable["Value"], e)
+                    values = self.InternalsDefaults.copy()
+                self.reconcile_internals(zone, values)
+
+                if self.state_backend == 2:
+                    self.write_internals(zone, 'updateuservariable')
+                    logger.log("Persistent variables migrated to {}", zone.state_store.path)
                 return
+
+        # no variable yet - created with the local state (the defaults on a first start)
+        zone.loading = False
+        zone.started_internals = None
+        self.save_internals(zone, add=True)
+
+
+    def reconcile_internals(self, zone, values):
+        # the stored Internals replace the local ones unless the zone changed since onStart, then the local state wins -
+        # a zone started without local state only keeps its mode and takes the stored PID values
+
+        if zone.started_internals is None or zone.Internals == zone.started_internals:
+            mode = zone.Internals["nValue"]
+            zone.Internals = values
+            zone.saved_internals = values.copy()
+            if values["nValue"] != mode:
+                logger.log("Zone {}: stored state differs from the local cache - {}", zone.unit, values)
+                self.apply_mode(zone)
+
         else:
-            domoticz.Error("Cannot read the uservariable holding the persistent variables")
-            self.Internals = self.InternalsDefaults.copy()
-       
+            if zone.loading:
+                for key in ('previous_error', 'integral', 'current_delta'):
+                    zone.Internals[key] = values[key]
+            zone.saved_internals = values.copy()
+            self.save_internals(zone, force=True)
+
+        zone.loading = False
+        zone.started_internals = None
+
+
     def check_params(self, param_list, min_length, param_name):
     
         if min_length > 0 and (param_list is None or len(param_list) < min_length):
             self.enabled = False
 
-            domoticz.Debug("Parameters {} are not valid - turning off SVTP".format(param_name))
-            domoticz.Debug(str(param_list))
+            logger.debug("Parameters {} are not valid - turning off SVTP", param_name)
+            logger.debug("{}", param_list)
     
 
 
 
 
 
+# aggregation of the room temperature sensors (Mode6 A)
+SENSORS_AVG = 1
+SENSORS_MIN = 2
+SENSORS_MAX = 3
+SENSORS_MEDIAN = 4
+SENSORS_WEIGHTED = 5  # mean weighted by the reading age
+
+
+# valve write priorities
+PRIORITY_NORMAL = 1  # PID adjustments
+PRIORITY_URGENT = 2  # mode changes, window pause
+
+
+# valve wake up learning (seconds)
+WAKE_LEAD = 30  # writes and calculations happen this long before the predicted wake up
+WAKE_ECHO = 60  # LastUpdate changes this close to our own write are ignored
+WAKE_MIN = 60  # shorter intervals are not wake ups of a battery valve
+WAKE_SAMPLES = 3  # intervals seen before predictions are used
+WAKE_POLLS = 20  # extra device reads per valve while learning
+
+
+# open window detection
+WINDOW_POLL = 60  # seconds between two reads of window sensors, notifications make them unnecessary
+DROP_RATE = 0.1  # degrees per minute of a temperature fall taken as an open window
+DROP_DELTA = 0.5  # degrees the fall must cover, sensors reporting often step by their resolution
+DROP_PAUSE_MAX = 30  # minutes, an inferred open window is assumed closed after
+DROP_HOLDOFF = 30  # minutes after an inferred window closed before a new drop is detected, the room recovers from the pause
+
+
+# telemetry file layout, see TelemetryRecorder and tools/telemetry.py
+TELEMETRY_MAGIC = b'SVTPTEL1'
+TELEMETRY_HEADER = struct.Struct('<8sHI32s192s')  # magic, record size, records per file, record format, field names
+TELEMETRY_COUNT = struct.Struct('<Q')  # records written
+TELEMETRY_COUNT_AT = 240
+TELEMETRY_DATA = 256  # first record
+TELEMETRY_RECORD = struct.Struct('<dHH9f')  # 48 bytes
+TELEMETRY_FIELDS = 'time,zone,status,temp,target,delta,error,integral,p,i,d,setpoint'
+TELEMETRY_CAPACITY = 87376  # records per file, 4 MiB
+TELEMETRY_KEEP = 6  # rotated files
+
+
+# device cache shared by the instances of one host
+SHARED_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+SHARED_MAGIC = b'SVTPDEV1'
+SHARED_HEADER = struct.Struct('<8sII')  # magic, slots, slot size
+SHARED_SLOT = struct.Struct('<IdH')  # idx, read time (epoch), json length
+SHARED_SLOTS = 1024
+SHARED_SLOT_SIZE = 512
+SHARED_KEYS = ('idx', 'Name', 'Type', 'SubType', 'Temp', 'SetPoint', 'AddjValue', 'Status', 'LastUpdate')
+SHARED_FRESH = 30  # seconds a reading of another instance is used instead of an API read
+
+
+# weekly schedule
+PREHEAT_MAX = 120  # minutes a switch to Normal may start early
+HEATUP_MIN_RISE = 0.5  # degrees below the high temperature for a heat-up to be timed
+HEATUP_MAX_HOURS = 6  # longer heat-ups are not timed
+HEATUP_WEIGHT = 0.3  # share of a new heat-up in the learned rate
+EXERCISE_TEMP = 5.0  # valve set point closing it for the exercise
+EXERCISE_STAGGER = 120  # seconds between two valves of the exercise
+
+
+# Domoticz heartbeat interval limits (seconds)
+HEARTBEAT_MIN = 1
+HEARTBEAT_MAX = 30
+HEARTBEAT_RETRY = 10
+HEARTBEAT_BUDGET = 0.2  # callback time after which the remaining work moves to the next heartbeat
+
+
+# Domoticz API failures
+READ_RETRIES = 2  # retries of a read when Domoticz is unreachable
+RETRY_DELAY = 0.5  # seconds before the first retry, doubled for the next one, jittered
+BREAKER_FAILURES = 5  # consecutive unreachable / timed out calls opening the circuit breaker
+BREAKER_COOLDOWN = 30  # seconds before the first probe call
+BREAKER_COOLDOWN_MAX = 300  # every failed probe doubles the cooldown up to this
+
+
+# metrics child devices, far above the Thermostat Mode units of the zones
+METRICS_UNITS = {'heartbeat': 241, 'api_latency': 242, 'api_errors': 243, 'valve_writes': 244, 'calc_done': 245, 'calc_skipped': 246}
+METRICS_DEVICES = {
+    'heartbeat': ("SVTP Heartbeat", "Custom", {"Custom": "1;ms"}),
+    'api_latency': ("SVTP API latency", "Custom", {"Custom": "1;ms"}),
+    'api_errors': ("SVTP API errors", "Counter Incremental", {}),
+    'valve_writes': ("SVTP Valve writes", "Custom", {"Custom": "1;per hour"}),
+    'calc_done': ("SVTP Calculations", "Custom", {"Custom": "1;calc"}),
+    'calc_skipped': ("SVTP Skipped calculations", "Custom", {"Custom": "1;calc"}),
+}
+
+
 global _plugin
 _plugin = BasePlugin()
 
@@ -649,6 +2884,11 @@ def onHeartbeat():
     _plugin.onHeartbeat()
 
 
+def onNotification(Name, Subject, Text, Status, Priority, Sound, ImageFile):
+    global _plugin
+    _plugin.onNotification(Name, Subject, Text, Status, Priority, Sound, ImageFile)
+
+
 # Plugin utility functions ---------------------------------------------------
 
 def parseCSV(strCSV, param_name, type):
@@ -675,7 +2915,123 @@ def parseCSV(strCSV, param_name, type):
          
     return listvals
 
+# Internals persistence format: a json list of the version followed by the values in this order
+INTERNALS_VERSION = 2
+INTERNALS_FIELDS = ('previous_error', 'integral', 'current_delta', 'target_temp', 'opened_window', 'nValue', 'heat_rate')
+
+
+def serialize_internals(internals):
+    values = [INTERNALS_VERSION] + [internals[field] for field in INTERNALS_FIELDS]
+    return json.dumps(values, separators=(',', ':'))
+
+
+def parse_internals(valuestring, defaults):
+    # returns the Internals dict, typed after defaults; raises ValueError on unreadable strings
+
+    valuestring = valuestring.strip()
+
+    if valuestring.startswith('{'):
+        # version 1: str(dict) written by older releases
+        values = ast.literal_eval(valuestring)
+        if not isinstance(values, dict):
+            raise ValueError("not a dict")
+
+    else:
+        fields = json.loads(valuestring)
+        if not isinstance(fields, list) or len(fields) == 0:
+            raise ValueError("not a list")
+
+        if fields[0] == 2:
+            values = dict(zip(INTERNALS_FIELDS, fields[1:]))
+        else:
+            raise ValueError("unknown version {}".format(fields[0]))
+
+    return {key: type(defaults[key])(value) for key, value in values.items() if key in defaults}
+
+
+SCHEDULE_DAYS = ('mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun')
+SCHEDULE_MODES = {'off': 0, 'normal': 1, 'economy': 2, 'pause': 3}
+
+
+def parse_schedule(text, zones_by_unit):
+    """Weekly rules of a schedule file, one per line:
+
+        <zone unit or *> <days> <HH:MM> off|normal|economy|pause
+        exercise <days> <HH:MM> <minutes>
+
+    days are mon..sun, ranges (mon-fri), lists (sat,sun) or * - returns ([(kind, units, weekday, minute, value)],
+    [(line number, error)])
+    """
+
+    rules, errors = [], []
+
+    for number, line in enumerate(text.splitlines(), 1):
+        tokens = line.split('#', 1)[0].split()
+        if len(tokens) == 0:
+            continue
+
+        try:
+            if len(tokens) != 4:
+                raise ValueError("4 values expected")
+
+            days = set()
+            for part in tokens[1].lower().split(','):
+                if part in ('*', 'daily'):
+                    days.update(range(7))
+                elif '-' in part:
+                    first, last = (SCHEDULE_DAYS.index(day) for day in part.split('-'))
+                    days.update(range(first, last + 1) if first <= last else itertools.chain(range(first, 7), range(last + 1)))
+                else:
+                    days.add(SCHEDULE_DAYS.index(part))
+
+            hours, minutes = (int(value) for value in tokens[2].split(':'))
+            if not (0 <= hours < 24 and 0 <= minutes < 60):
+                raise ValueError("invalid time")
+            minute = 60 * hours + minutes
+
+            if tokens[0].lower() == 'exercise':
+                kind, units, value = 'exercise', [], int(tokens[3])
+            else:
+                kind = 'mode'
+                units = sorted(zones_by_unit) if tokens[0] == '*' else [int(tokens[0])]
+                if any(unit not in zones_by_unit for unit in units):
+                    raise ValueError("unknown zone {}".format(tokens[0]))
+                value = SCHEDULE_MODES[tokens[3].lower()]
+
+        except (ValueError, KeyError) as e:
+            errors.append((number, "{} - '{}'".format(e, line.strip())))
+            continue
+
+        rules.extend((kind, units, weekday, minute, value) for weekday in sorted(days))
+
+    return rules, errors
+
+
+def next_weekly(now, weekday, minute):
+    # first time after now on the weekday (0 - Monday) at minute of the day
+
+    day = now.replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=(weekday - now.weekday()) % 7)
+    at = day + timedelta(minutes=minute)
+    return at if at > now else at + timedelta(days=7)
+
+
+def parseZonesCSV(strCSV, param_name, type):
+    # one csv list per zone, zones separated by ';' - None when any zone is invalid
+
+    zones = []
+
+    for strZone in strCSV.split(";"):
+        values = parseCSV(strZone.strip(), param_name, type)
+        if values is None:
+            return None
+        zones.append(values)
+
+    return zones
+
+
+@functools.lru_cache(maxsize=256)
 def ParseDateTime(datestring):
+    # cached - the same LastUpdate strings come back with every device read
     dateformat = "%Y-%m-%d %H:%M:%S"
     
     # the below try/except is meant to address an intermittent python bug in some embedded systems
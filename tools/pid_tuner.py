@@ -0,0 +1,309 @@
+"""Offline PID tuner: fits a room thermal model to recorded history and searches the Mode4/Mode6 values
+
+    python tools/pid_tuner.py history.csv --mode4 21,20,5,0.5,0.1,2 --mode5 3,1,10,90,15 --mode6 0.9,0.1,0.2,0,1,1
+
+history.csv has a header line and the columns time (YYYY-MM-DD HH:MM:SS or epoch seconds), temp (room temperature)
+and setpoint (valve set point, may be empty on rows with a temperature only).
+
+The room is modelled as dT/dt = heat * (valve set point - T) + loss * (outside - T), fitted by least squares. Every
+candidate of the grid (Kp, Ki, Kd, max_shift, trv_prec_temp) is then simulated at once with NumPy on a step from the
+Low to the High temperature: the PID update mirrors compute_shifts of plugin.py (rounding, precision skip, max shift
+hold and clamping), valves are written when the set point moves by trv_prec_temp. Candidates are ranked by the
+integrated temperature error plus a cost per valve write; --verify checks the NumPy update against plugin.py.
+"""
+
+import argparse
+import csv
+import os
+import sys
+from datetime import datetime
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+HARNESS_DIR = os.path.join(os.path.dirname(TOOLS_DIR), 'harness')
+
+STEP = 60  # seconds per simulation step
+INTEGRAL_DEFAULT = -10.0  # Internals default of plugin.py
+
+
+def parse_time(value):
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.strptime(value.strip(), '%Y-%m-%d %H:%M:%S').timestamp()
+
+
+def parse_values(text):
+    return [float(value) for value in text.split(",") if value.strip() != ""]
+
+
+def parse_grid(spec):
+    # "start:stop:step" (stop included) or "v1,v2,..."
+
+    if ":" in spec:
+        start, stop, step = (float(value) for value in spec.split(":"))
+        return np.round(np.arange(start, stop + step / 2.0, step), 6)
+    return np.array(parse_values(spec))
+
+
+def load_history(path, step=STEP):
+    """Temperature and valve set point resampled every step seconds"""
+
+    times, temps, set_times, setpoints = [], [], [], []
+    with open(path, newline='') as f:
+        for row in csv.DictReader(f):
+            t = parse_time(row['time'])
+            if row.get('temp', '').strip() != '':
+                times.append(t)
+                temps.append(float(row['temp']))
+            if row.get('setpoint', '').strip() != '':
+                set_times.append(t)
+                setpoints.append(float(row['setpoint']))
+
+    if len(temps) < 10 or len(setpoints) == 0:
+        raise ValueError("{}: at least 10 temperatures and one set point are needed".format(path))
+
+    times, temps = np.array(times), np.array(temps)
+    order = np.argsort(times)
+    times, temps = times[order], temps[order]
+    set_order = np.argsort(set_times)
+    set_times, setpoints = np.array(set_times)[set_order], np.array(setpoints)[set_order]
+
+    grid = np.arange(times[0], times[-1], step)
+    temp = np.interp(grid, times, temps)
+    # a set point holds until the next one, the first one also before it
+    held = np.searchsorted(set_times, grid, side='right') - 1
+    setpoint = setpoints[np.maximum(held, 0)]
+    return temp, setpoint
+
+
+class ThermalModel:
+    """dT/dt = heat * (setpoint - T) + loss * (outside - T), per minute"""
+
+    def __init__(self, heat, loss, outside, r2):
+        self.heat = heat
+        self.loss = loss
+        self.outside = outside
+        self.r2 = r2
+
+    @classmethod
+    def fit(cls, temp, setpoint, step=STEP, horizon=5):
+        # differences over horizon minutes smooth the sensor resolution steps
+
+        k = max(1, int(round(horizon * 60.0 / step)))
+        rate = (temp[k:] - temp[:-k]) / (k * step / 60.0)
+        x = np.column_stack([setpoint[:-k] - temp[:-k], -temp[:-k], np.ones(len(rate))])
+
+        coef, residuals, rank, sv = np.linalg.lstsq(x, rate, rcond=None)
+        if rank < 3:
+            raise ValueError("the history does not vary enough (set point and temperature) to fit a model")
+
+        heat, loss, offset = coef
+        if heat <= 0:
+            raise ValueError("fitted heating gain {:.4f} is not positive - the history shows no valve effect".format(heat))
+
+        loss = max(loss, 1e-5)
+        fitted = x.dot(coef)
+        r2 = 1.0 - np.sum((rate - fitted) ** 2) / max(np.sum((rate - rate.mean()) ** 2), 1e-12)
+        return cls(heat, loss, offset / loss, r2)
+
+    def __str__(self):
+        return "heat {:.4f}/min, loss {:.4f}/min, outside {:.1f} C, R2 {:.2f}".format(self.heat, self.loss,
+                                                                                   self.outside, self.r2)
+
+
+def pid_update(kp, ki, kd, max_shift, sensor_prec, target, current, integral, previous_error, current_delta):
+    """compute_shifts of plugin.py in PID mode, element-wise over candidates
+
+    Returns (updated, integral, previous_error, current_delta), updated is False where compute_shifts skips.
+    """
+
+    active = np.abs(current - target) > sensor_prec * 2.0
+    error = np.round(target - current, 2)
+
+    hold = (np.abs(current_delta) == max_shift) & \
+        (((current_delta < 0) & (error < 0) & (error <= previous_error)) |
+         ((current_delta > 0) & (error > 0) & (error >= previous_error)))
+    updated = active & ~hold
+
+    new_integral = np.round(integral + error, 2)
+    derivative = np.round(error - previous_error, 2)
+    shift = np.round(np.round(kp * error, 2) + np.round(ki * new_integral, 2) + np.round(kd * derivative, 2), 1)
+    shift = np.clip(shift, -max_shift, max_shift)
+
+    return (updated, np.where(updated, new_integral, integral), np.where(updated, error, previous_error),
+            np.where(updated, shift, current_delta))
+
+
+def simulate(model, candidates, target, start, sensor_prec, calc_period, hours, band, hold, integral=INTEGRAL_DEFAULT):
+    """Step response of every candidate, returns (settling minutes - inf when not settled, valve writes, error C*h)"""
+
+    kp, ki, kd, max_shift, trv_prec = candidates
+    count = len(kp)
+    steps = int(hours * 3600 / STEP)
+    period = max(1, int(round(calc_period * 60.0 / STEP)))
+    dt = STEP / 60.0
+
+    temp = np.full(count, float(start))
+    valve = np.full(count, float(target))
+    integral = np.full(count, float(integral))
+    previous_error = np.zeros(count)
+    current_delta = np.zeros(count)
+    writes = np.zeros(count, dtype=np.int64)
+    error = np.zeros(count)
+    last_outside = np.full(count, -1, dtype=np.int64)
+
+    for n in range(steps):
+        if n % period == 0:
+            # sensors report 0.1 C, get_current_temp rounds the room temperature to 0.1
+            current = np.round(temp, 1)
+            updated, integral, previous_error, current_delta = pid_update(
+                kp, ki, kd, max_shift, sensor_prec, target, current, integral, previous_error, current_delta)
+
+            # set_target_temp: a calculated set point is sent when it moved by trv_prec_temp
+            setpoint = target + current_delta
+            write = updated & (np.abs(setpoint - valve) >= trv_prec)
+            valve = np.where(write, setpoint, valve)
+            writes += write
+
+        temp += dt * (model.heat * (valve - temp) + model.loss * (model.outside - temp))
+
+        deviation = np.abs(temp - target)
+        error += deviation * dt / 60.0
+        last_outside = np.where(deviation > band, n, last_outside)
+
+    settling = (last_outside + 1) * dt
+    settling = np.where(last_outside < steps - 1 - int(hold * 60 / dt), settling, np.inf)
+    return settling, writes, error
+
+
+def candidates_grid(kp, ki, kd, max_shift, trv_prec):
+    mesh = np.meshgrid(kp, ki, kd, max_shift, trv_prec, indexing='ij')
+    return [values.ravel() for values in mesh]
+
+
+def replace_values(text, values, count):
+    # first group of a Mode4/Mode6 string with its first values replaced, other zone groups kept
+
+    groups = text.split(";")
+    first = [value.strip() for value in groups[0].split(",")]
+    first += [""] * (count - len(first))
+    for i, value in values.items():
+        first[i] = "{:g}".format(value)
+    groups[0] = ",".join(first)
+    return ";".join(groups)
+
+
+def verify(samples=5000, seed=1):
+    """Mismatches between pid_update and compute_shifts of plugin.py on random states"""
+
+    sys.path.insert(0, HARNESS_DIR)
+    from array import array
+    from runner import load_plugin
+
+    plugin = load_plugin('svtp_tuner_check')
+    rng = np.random.default_rng(seed)
+
+    kp = np.round(rng.uniform(0, 3, samples), 2)
+    ki = np.round(rng.uniform(0, 0.5, samples), 2)
+    kd = np.round(rng.uniform(0, 2, samples), 2)
+    max_shift = rng.choice([1.0, 1.5, 2.0, 3.0], samples)
+    target = rng.choice([20.0, 20.5, 21.0], samples)
+    current = np.round(target + rng.uniform(-3, 3, samples), 1)
+    integral = np.round(rng.uniform(-20, 20, samples), 2)
+    previous_error = np.round(rng.uniform(-3, 3, samples), 2)
+    current_delta = np.where(rng.random(samples) < 0.3, max_shift * rng.choice([-1, 1], samples),
+                             np.round(rng.uniform(-3, 3, samples), 1))
+
+    updated, v_integral, v_previous, v_delta = pid_update(kp, ki, kd, max_shift, 0.1, target, current, integral,
+                                                          previous_error, current_delta)
+
+    mismatches = 0
+    for i in range(samples):
+        columns = [array('d', [value]) for value in (target[i], current[i], integral[i], previous_error[i],
+                                                     current_delta[i])]
+        status, derivative = plugin.compute_shifts(1, kp[i], ki[i], kd[i], max_shift[i], 0.1, *columns)
+        expected = (status[0] == plugin.CALC_DONE, columns[2][0], columns[3][0], columns[4][0])
+        if expected != (updated[i], v_integral[i], v_previous[i], v_delta[i]):
+            mismatches += 1
+
+    return mismatches, samples
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Fit a room model to recorded history and search PID parameters")
+    parser.add_argument('history', nargs='?', help="csv with time,temp,setpoint columns")
+    parser.add_argument('--mode4', default='21,20,5,0.5,0.1,2', help="current High/Low/Pause/Precision/Max shift")
+    parser.add_argument('--mode5', default='3,1,10,90,15', help="current Calc. interval/.../Save interval")
+    parser.add_argument('--mode6', default='0.9,0.1,0.2,0,1,1', help="current P/I/D/Debug/E/C/S/M/A")
+    parser.add_argument('--kp', default='0.2:2.0:0.1', help="grid, start:stop:step or csv")
+    parser.add_argument('--ki', default='0:0.3:0.02')
+    parser.add_argument('--kd', default='0:1.0:0.1')
+    parser.add_argument('--max-shift', default='1,1.5,2,3')
+    parser.add_argument('--trv-prec', default='0.1,0.2,0.5')
+    parser.add_argument('--hours', type=float, default=8.0, help="simulated time after the Low -> High step")
+    parser.add_argument('--band', type=float, default=0.3, help="C around the target counted as settled")
+    parser.add_argument('--hold', type=float, default=1.0, help="hours within the band to count as settled")
+    parser.add_argument('--write-cost', type=float, default=0.02, help="C*h of error one valve write is worth")
+    parser.add_argument('--top', type=int, default=5)
+    parser.add_argument('--verify', action='store_true', help="check the NumPy PID update against plugin.py")
+    args = parser.parse_args()
+
+    if np is None:
+        sys.exit("pid_tuner needs NumPy (pip install numpy), the plugin itself does not")
+
+    if args.verify:
+        mismatches, samples = verify()
+        print("{} of {} random PID updates differ from plugin.py compute_shifts".format(mismatches, samples))
+        sys.exit(1 if mismatches else 0)
+
+    if args.history is None:
+        parser.error("the history csv is required")
+
+    mode4 = parse_values(args.mode4.split(";")[0])
+    mode5 = parse_values(args.mode5)
+    if len(mode4) != 6 or len(mode5) < 4:
+        parser.error("--mode4 needs 6 values and --mode5 at least 4")
+    high, low, sensor_prec, calc_period = mode4[0], mode4[1], mode4[4], mode5[0]
+
+    try:
+        model = ThermalModel.fit(*load_history(args.history))
+    except (OSError, KeyError, ValueError) as e:
+        sys.exit("Cannot fit a model: {}".format(e))
+    print("model: {}".format(model))
+
+    candidates = candidates_grid(parse_grid(args.kp), parse_grid(args.ki), parse_grid(args.kd),
+                                 parse_grid(args.max_shift), parse_grid(args.trv_prec))
+    settling, writes, error = simulate(model, candidates, high, low, sensor_prec, calc_period, args.hours,
+                                       args.band, args.hold)
+
+    cost = np.where(np.isfinite(settling), error + args.write_cost * writes, np.inf)
+    ranked = np.argsort(cost)[:args.top]
+    print("{} candidates, {} settle within {:.1f} h".format(len(cost), int(np.isfinite(settling).sum()), args.hours))
+
+    if not np.isfinite(cost[ranked[0]]):
+        sys.exit("no candidate settles within {} C - widen the grid, --band or --hours".format(args.band))
+
+    print("   Kp    Ki    Kd  shift  prec  settle min  writes  error C*h")
+    for i in ranked:
+        if not np.isfinite(cost[i]):
+            break
+        print("{:5.2f} {:5.2f} {:5.2f} {:6.1f} {:5.1f} {:11.0f} {:7d} {:10.2f}".format(
+            candidates[0][i], candidates[1][i], candidates[2][i], candidates[3][i], candidates[4][i],
+            settling[i], writes[i], error[i]))
+
+    best = ranked[0]
+    print("Mode4: {}".format(replace_values(args.mode4, {3: candidates[4][best], 5: candidates[3][best]}, 6)))
+    print("Mode6: {}".format(replace_values(args.mode6, {0: candidates[0][best], 1: candidates[1][best],
+                                                         2: candidates[2][best], 4: 1}, 6)))
+    print("predicted: settled after {:.0f} min, {} valve writes in {:g} h".format(settling[best], writes[best],
+                                                                                 args.hours))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+"""Reader of the telemetry files written with Mode6 T=1 (svtp-<hardware id>.telemetry in the plugin folder)
+
+    python tools/telemetry.py svtp-1.telemetry --zone 1 > history.csv
+    python tools/telemetry.py svtp-1.telemetry --npz history.npz
+
+Rotated files (.telemetry.1 is the newest) are read first, oldest to newest. The files describe their own records
+(struct format and field names in the header), so older files stay readable when the record changes. CSV is streamed
+with the standard library, --npz needs NumPy. The CSV columns time, temp and setpoint are the input of pid_tuner.py.
+"""
+
+import argparse
+import csv
+import os
+import struct
+import sys
+from datetime import datetime
+
+MAGIC = b'SVTPTEL1'
+HEADER = struct.Struct('<8sHI32s192s')  # magic, record size, records per file, record format, field names
+COUNT = struct.Struct('<Q')
+COUNT_AT = 240
+DATA = 256
+
+# struct codes of the record formats to NumPy types
+NUMPY_TYPES = {'d': 'f8', 'f': 'f4', 'q': 'i8', 'Q': 'u8', 'i': 'i4', 'I': 'u4', 'h': 'i2', 'H': 'u2', 'b': 'i1',
+               'B': 'u1'}
+
+
+class TelemetryFile:
+    """Header of one telemetry file"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            head = f.read(DATA)
+        if len(head) < DATA:
+            raise ValueError("{}: too short for a telemetry file".format(path))
+
+        magic, size, self.capacity, fmt, names = HEADER.unpack_from(head, 0)
+        if magic != MAGIC:
+            raise ValueError("{}: not a telemetry file".format(path))
+
+        self.record = struct.Struct(fmt.rstrip(b'\0').decode())
+        if self.record.size != size:
+            raise ValueError("{}: record size {} does not match its format".format(path, size))
+        self.fields = names.rstrip(b'\0').decode().split(",")
+        self.count = min(COUNT.unpack_from(head, COUNT_AT)[0], self.capacity)
+
+    def records(self, chunk=4096):
+        # record tuples, read chunk records at a time
+
+        with open(self.path, 'rb') as f:
+            f.seek(DATA)
+            left = self.count
+            while left > 0:
+                data = f.read(min(left, chunk) * self.record.size)
+                if not data:
+                    return
+                for values in self.record.iter_unpack(data[:len(data) - len(data) % self.record.size]):
+                    yield values
+                left -= len(data) // self.record.size
+
+    def dtype(self):
+        # NumPy structured type of the records
+
+        fmt = self.record.format.lstrip('<>=!@')
+        codes, repeat = [], ""
+        for char in fmt:
+            if char.isdigit():
+                repeat += char
+            else:
+                codes.extend([char] * int(repeat or 1))
+                repeat = ""
+        return [(name, '<' + NUMPY_TYPES[code]) for name, code in zip(self.fields, codes)]
+
+
+def telemetry_files(path):
+    # rotated files oldest first, then the current one
+
+    rotated = []
+    n = 1
+    while os.path.exists("{}.{}".format(path, n)):
+        rotated.append("{}.{}".format(path, n))
+        n += 1
+    paths = rotated[::-1]
+    if os.path.exists(path):
+        paths.append(path)
+    return [TelemetryFile(p) for p in paths]
+
+
+def iter_records(path, zone=None):
+    """Records of the current and rotated files as dicts, oldest first"""
+
+    for telemetry in telemetry_files(path):
+        for values in telemetry.records():
+            record = dict(zip(telemetry.fields, values))
+            if zone is None or record['zone'] == zone:
+                yield record
+
+
+def read_arrays(path, zone=None):
+    """Records of the current and rotated files as one NumPy structured array, oldest first"""
+
+    import numpy as np
+
+    arrays = []
+    for telemetry in telemetry_files(path):
+        arrays.append(np.fromfile(telemetry.path, dtype=np.dtype(telemetry.dtype()), count=telemetry.count,
+                                  offset=DATA))
+    if len(arrays) == 0:
+        return np.zeros(0)
+
+    # files of different layouts are joined on their common fields
+    common = [name for name in arrays[-1].dtype.names if all(name in a.dtype.names for a in arrays)]
+    records = np.concatenate([a[common] for a in arrays]) if len(arrays) > 1 else arrays[0]
+    if zone is not None:
+        records = records[records['zone'] == zone]
+    return records
+
+
+def write_csv(path, out, zone=None):
+
+    writer = None
+    for record in iter_records(path, zone):
+        if writer is None:
+            writer = csv.DictWriter(out, fieldnames=list(record))
+            writer.writeheader()
+        record['time'] = datetime.fromtimestamp(record['time']).strftime('%Y-%m-%d %H:%M:%S')
+        writer.writerow({k: round(v, 3) if isinstance(v, float) else v for k, v in record.items()})
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Read SVTP telemetry files as csv or NumPy arrays")
+    parser.add_argument('path', help="current telemetry file, rotated ones are found next to it")
+    parser.add_argument('--zone', type=int, help="only this zone (Thermostat Mode unit)")
+    parser.add_argument('--npz', help="save the records as NumPy arrays instead of printing csv")
+    args = parser.parse_args()
+
+    try:
+        if args.npz:
+            try:
+                import numpy as np
+            except ImportError:
+                sys.exit("--npz needs NumPy (pip install numpy), csv output does not")
+            records = read_arrays(args.path, args.zone)
+            np.savez_compressed(args.npz, **{name: records[name] for name in records.dtype.names or ()})
+            print("{} records saved to {}".format(len(records), args.npz))
+        else:
+            write_csv(args.path, sys.stdout, args.zone)
+    except BrokenPipeError:
+        pass  # output piped into head
+    except (OSError, ValueError) as e:
+        sys.exit(str(e))
+
+
+if __name__ == '__main__':
+    main()